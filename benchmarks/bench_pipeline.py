@@ -0,0 +1,163 @@
+''' Time the consort data pipeline and callbacks against synthetic data served by a local stand-in TACC server.
+
+Reports the best wall time and the peak traced memory of each stage:
+load_data (cold and cached downloads), get_sankey_dataframe, build_sankey, build_datatable
+and the show_store_data callback end to end.
+
+With --source dir, zip or tar the report is written to a temporary directory or archive and read through the
+local files backend instead, without any network access.
+
+Usage: python benchmarks/bench_pipeline.py --mccs 2 8 32 --dates 5 --latency 0.05
+       python benchmarks/bench_pipeline.py --mccs 2 8 32 --source tar
+'''
+import argparse
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from contextlib import contextmanager
+
+# The cache directory is read when the app modules are imported, so point it somewhere disposable first
+os.environ.setdefault('CACHE_PATH', tempfile.mkdtemp(prefix='a2cps_bench_'))
+os.environ.setdefault('REFRESH_INTERVAL', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import app # noqa: E402
+from data_processing import load_data, get_latest_files_list, get_sankey_dataframe # noqa: E402
+from http_client import get_file_cache # noqa: E402
+import local_client # noqa: E402
+from fake_tacc_server import FakeTaccServer # noqa: E402
+from synthetic_data import make_report_files # noqa: E402
+
+
+def measure(func, repeat=3):
+    ''' Return (best seconds, peak traced bytes, result) over repeat calls of func '''
+    best = None
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak, result
+
+
+def clear_directory(directory):
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+
+
+def clear_file_cache():
+    clear_directory(get_file_cache().directory)
+
+
+def clear_unpacked_archives():
+    local_client._archive_roots.clear()
+    shutil.rmtree(str(local_client.ARCHIVES_PATH), ignore_errors=True)
+
+
+@contextmanager
+def serve_report(files, source, latency):
+    ''' Make the report files available as a file_url_root: from the fake TACC server (source 'http'),
+    or written to a temporary directory, zip or tar.gz archive ('dir', 'zip', 'tar')
+    '''
+    if source == 'http':
+        with FakeTaccServer(files, latency=latency) as server:
+            yield server.url
+        return
+    directory = tempfile.mkdtemp(prefix='a2cps_bench_reports_')
+    try:
+        if source == 'zip':
+            root = os.path.join(directory, 'reports.zip')
+            with zipfile.ZipFile(root, 'w') as zf:
+                for path, content in files.items():
+                    zf.writestr(path, content)
+        elif source == 'tar':
+            root = os.path.join(directory, 'reports.tar.gz')
+            with tarfile.open(root, 'w:gz') as tf:
+                for path, content in files.items():
+                    info = tarfile.TarInfo(path)
+                    info.size = len(content)
+                    tf.addfile(info, io.BytesIO(content))
+        else:
+            root = directory
+            for path, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+                with open(os.path.join(root, path), 'wb') as f:
+                    f.write(content)
+        yield root
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(n_mccs, n_dates, n_stages, extra_reasons, latency, repeat, source='http'):
+    files = make_report_files(app.report, n_mccs, n_dates, n_stages, extra_reasons)
+    mcc_list = list(range(1, n_mccs + 1))
+    results = []
+    with serve_report(files, source, latency) as file_url_root:
+        app.file_url_root = file_url_root
+        app.mcc_list = mcc_list
+        latest_files = get_latest_files_list(app.report_suffix, mcc_list)
+
+        def cold_load():
+            clear_file_cache()
+            clear_unpacked_archives()
+            return load_data(file_url_root, app.report, latest_files)[0]
+        results.append(('load_data (cold)',) + measure(cold_load, repeat)[:2])
+        seconds, peak, df = measure(lambda: load_data(file_url_root, app.report, latest_files)[0], repeat)
+        results.append(('load_data (cached)', seconds, peak))
+
+        selected_df = df[df['mcc'] == '1']
+        seconds, peak, (nodes, sankey_df) = measure(lambda: get_sankey_dataframe(selected_df), repeat)
+        results.append(('get_sankey_dataframe', seconds, peak))
+        results.append(('build_sankey',) + measure(lambda: app.build_sankey(nodes, sankey_df), repeat)[:2])
+        results.append(('build_datatable',) + measure(lambda: app.build_datatable(selected_df, 'table_selected'), repeat)[:2])
+
+        handle = app.set_dropdown_dates_value('latest')
+
+        def show_uncached():
+            app.figure_cache = app.LRUCache(app.FIGURE_CACHE_MAX_BYTES, size_func=app.selection_size)
+            clear_directory(app.get_figure_store().directory)
+            return app.show_store_data('1', 'snapshot', handle, 'latest')
+        results.append(('show_store_data (cold)',) + measure(show_uncached, repeat)[:2])
+        results.append(('show_store_data (cached)',) + measure(lambda: app.show_store_data('1', 'snapshot', handle, 'latest'), repeat)[:2])
+
+        def table_page():
+            # the callback reads callback_context, which needs a request
+            with app.app.server.test_request_context('/'):
+                return app.update_table_page(0, app.TABLE_PAGE_SIZE, [], '', '1', 'snapshot', handle, 'latest')
+        results.append(('update_table_page',) + measure(table_page, repeat)[:2])
+    return len(df), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mccs', type=int, nargs='+', default=[2, 8, 32], help='numbers of MCCs to benchmark')
+    parser.add_argument('--dates', type=int, default=5, help='historical dates in the synthetic index.json')
+    parser.add_argument('--stages', type=int, default=7, help='consort stages per MCC')
+    parser.add_argument('--extra-reasons', type=int, default=0, help='extra dropout reasons per stage')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency per request')
+    parser.add_argument('--source', choices=['http', 'dir', 'zip', 'tar'], default='http',
+                        help='serve the report over HTTP or read it from a local directory or archive')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>5} {:>7} {:<26} {:>10} {:>12}'.format('mccs', 'links', 'stage', 'best (ms)', 'peak (KiB)'))
+    for n_mccs in args.mccs:
+        n_links, results = run(n_mccs, args.dates, args.stages, args.extra_reasons, args.latency, args.repeat,
+                                  args.source)
+        for name, seconds, peak in results:
+            print('{:>5} {:>7} {:<26} {:>10.1f} {:>12.1f}'.format(n_mccs, n_links, name, seconds * 1000, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+''' Compare the factorize-based Sankey encoder with the previous unique() + double merge implementation.
+Before timing, checks that rows with a missing source or target are neither drawn as links of another node
+nor loaded from a csv file.
+
+Usage: python benchmarks/bench_sankey_encode.py [n_links ...]
+'''
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from data_processing import get_sankey_dataframe, get_sankey_nodes, ingest_consort_files # noqa: E402
+from synthetic_data import make_flow_table # noqa: E402
+
+
+def merge_sankey_dataframe(data_dataframe):
+    ''' Previous implementation, kept here as the baseline '''
+    nodes = pd.DataFrame(list(data_dataframe['source'].unique()) + list(data_dataframe['target'].unique())).drop_duplicates().reset_index(drop=True)
+    nodes.reset_index(inplace=True)
+    nodes.columns = ['NodeID','Node']
+    sources = nodes.copy()
+    sources.columns = ['sourceID','source']
+    targets = nodes.copy()
+    targets.columns = ['targetID','target']
+    sankey_dataframe = data_dataframe.merge(sources, on='source')
+    sankey_dataframe = sankey_dataframe.merge(targets, on='target')
+    return nodes, sankey_dataframe
+
+
+def check_missing_labels():
+    ''' A missing label used to get factorize code -1 and be encoded as the last node, so ",C,3" was drawn as B -> C '''
+    df, failures = ingest_consort_files([('1', 'missing.csv', b'A,B,5\nB,C,4\n,C,3\n')])
+    assert df[['source', 'target']].values.tolist() == [['A', 'B'], ['B', 'C']], df
+    assert len(failures) == 1 and 'missing' in failures[0]['error'], failures
+
+    raw = pd.DataFrame({'source': ['A', 'B', np.nan], 'target': ['B', 'C', 'C'], 'value': [5, 4, 3]})
+    for frame in [raw, raw.astype({'source': 'category', 'target': 'category'})]:
+        for shared_nodes in [None, get_sankey_nodes(frame)]:
+            nodes, links = get_sankey_dataframe(frame, shared_nodes=shared_nodes)
+            missing_source = nodes['Node'].to_numpy()[links['sourceID'].to_numpy()[2]]
+            assert pd.isna(missing_source), 'missing source encoded as {!r}'.format(missing_source)
+
+
+def best_of(func, df, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(df)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(sizes):
+    check_missing_labels()
+    print('{:>10} {:>12} {:>12} {:>14} {:>8}'.format('links', 'columns', 'merge (s)', 'factorize (s)', 'speedup'))
+    for n_links in sizes:
+        df = make_flow_table(n_links)
+        # load_data returns categorical label columns, so time both representations
+        for kind, frame in [('object', df), ('category', df.astype({'source': 'category', 'target': 'category'}))]:
+            baseline = best_of(merge_sankey_dataframe, frame)
+            encoded = best_of(get_sankey_dataframe, frame)
+            print('{:>10} {:>12} {:>12.4f} {:>14.4f} {:>7.1f}x'.format(n_links, kind, baseline, encoded, baseline / encoded))
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10**5, 10**6]
+    main(sizes)
@@ -0,0 +1,115 @@
+''' Time how long a fresh interpreter takes to import the app and to serve its first page, and fail on regressions.
+
+Each run starts a new python process that imports app and calls app.warm_imports(), as the gunicorn master does
+with preload_app, and then requests / and /_dash-layout through the Flask test client. Network connections opened
+during import or while building the layout are counted: the page shell must be served from local state only.
+
+startup is import plus warm_imports: the time the gunicorn master takes before it forks the workers.
+
+Exits with status 1 if any connection was opened, if the best time of a stage is over its --max-* limit, or if it
+is more than --tolerance slower than the times recorded with --save-baseline. The default limits leave room
+over the times of a run in the Docker image (import 0.8s, warm_imports 0.5s, first response 15ms), so a default run
+fails on a large regression on any machine; use a baseline to catch smaller ones. The pull request workflow runs it
+in the built image.
+
+Usage: python benchmarks/bench_startup.py --repeat 5
+       python benchmarks/bench_startup.py --save-baseline   # then rerun without it after a change
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+DEFAULT_BASELINE = os.path.join(tempfile.gettempdir(), 'a2cps_startup_baseline.json')
+
+# Run in the child process. Prints one JSON line with the timings and the connections attempted.
+CHILD = '''
+import json, socket, time
+start = time.perf_counter()
+connections = []
+_connect = socket.socket.connect
+def connect(self, address):
+    connections.append(repr(address))
+    return _connect(self, address)
+socket.socket.connect = connect
+
+import app
+imported = time.perf_counter()
+app.warm_imports()
+warmed = time.perf_counter()
+client = app.app.server.test_client()
+statuses = [client.get('/').status_code, client.get('/_dash-layout').status_code]
+served = time.perf_counter()
+print(json.dumps({'import': imported - start, 'warm_imports': warmed - imported, 'first_response': served - warmed,
+                  'statuses': statuses, 'connections': connections}))
+'''
+
+STAGES = ['import', 'warm_imports', 'startup', 'first_response']
+
+
+def run_once():
+    ''' Import the app and serve the first page in a new interpreter, with an empty cache directory '''
+    env = dict(os.environ, CACHE_PATH=tempfile.mkdtemp(prefix='a2cps_startup_'), REFRESH_INTERVAL='0')
+    output = subprocess.run([sys.executable, '-c', CHILD], cwd=SRC_PATH, env=env,
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    run = json.loads(output.strip().splitlines()[-1])
+    run['startup'] = run['import'] + run['warm_imports']
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-import', type=float, default=2.0, help='seconds allowed for import app')
+    parser.add_argument('--max-warm-imports', type=float, default=1.0, help='seconds allowed for app.warm_imports()')
+    parser.add_argument('--max-startup', type=float, default=2.5, help='seconds allowed for import and warm_imports')
+    parser.add_argument('--max-first-response', type=float, default=0.1, help='seconds allowed to serve / and the layout')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON file of baseline timings')
+    parser.add_argument('--save-baseline', action='store_true', help='record this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown over the baseline')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.repeat)]
+    best = {stage: min(run[stage] for run in runs) for stage in STAGES}
+    print('{:<16} {:>10} {:>12}'.format('stage', 'best (ms)', 'median (ms)'))
+    for stage in STAGES:
+        print('{:<16} {:>10.1f} {:>12.1f}'.format(stage, best[stage] * 1000,
+                                                  statistics.median(run[stage] for run in runs) * 1000))
+
+    failures = []
+    connections = sorted(set(address for run in runs for address in run['connections']))
+    if connections:
+        failures.append('network connections during startup: {}'.format(', '.join(connections)))
+    statuses = sorted(set(status for run in runs for status in run['statuses']))
+    if statuses != [200]:
+        failures.append('first responses returned status {}'.format(statuses))
+    limits = {'import': args.max_import, 'warm_imports': args.max_warm_imports, 'startup': args.max_startup,
+              'first_response': args.max_first_response}
+    for stage in STAGES:
+        if limits[stage] is not None and best[stage] > limits[stage]:
+            failures.append('{} took {:.3f}s, over the {:.3f}s limit'.format(stage, best[stage], limits[stage]))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(best, f)
+        print('Saved baseline to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for stage in [stage for stage in STAGES if stage in baseline]:
+            allowed = baseline[stage] * (1 + args.tolerance)
+            if best[stage] > allowed:
+                failures.append('{} took {:.3f}s, {:.0%} slower than the baseline {:.3f}s'.format(
+                    stage, best[stage], best[stage] / baseline[stage] - 1, baseline[stage]))
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+''' Local stand-in for the TACC files API, serving an in-memory report directory with configurable latency '''
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTaccServer:
+    ''' Serve {path: bytes} over HTTP on localhost in a background thread.
+    Every request sleeps for latency seconds before responding. Responses carry an ETag and honour
+    If-None-Match, like the real API, and request counts are kept per path in requests.
+
+        with FakeTaccServer(files, latency=0.05) as server:
+            load_data(server.url, 'consort', files_list)
+    '''
+    def __init__(self, files, latency=0.0, port=0):
+        self.files = dict(files)
+        self.latency = latency
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_address[1])
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = self.path.lstrip('/')
+                with server._lock:
+                    server.requests[path] = server.requests.get(path, 0) + 1
+                if server.latency:
+                    time.sleep(server.latency)
+                content = server.files.get(path)
+                if content is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
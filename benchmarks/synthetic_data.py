@@ -0,0 +1,104 @@
+''' Synthetic consort flow tables for benchmarking the data pipeline '''
+import json
+
+import numpy as np
+import pandas as pd
+
+
+def make_flow_table(n_links, n_nodes=None, n_mccs=2, seed=0):
+    ''' Random flow table with the consort schema (source, target, value, mcc).
+    Node labels are long strings like the real consort report so hashing cost is realistic.
+    '''
+    rng = np.random.default_rng(seed)
+    if n_nodes is None:
+        n_nodes = max(2, int(np.sqrt(n_links)))
+    labels = np.array(['Withdrawl Prior to Surgery - Synthetic reason number {}'.format(i) for i in range(n_nodes)],
+                      dtype=object)
+    sources = rng.integers(0, n_nodes, n_links)
+    targets = rng.integers(0, n_nodes, n_links)
+    return pd.DataFrame({
+        'source': labels[sources],
+        'target': labels[targets],
+        'value': rng.integers(1, 1000, n_links),
+        'mcc': (rng.integers(1, n_mccs + 1, n_links)).astype(str),
+    })
+
+
+# ----------------------------------------------------------------------------
+# Realistic consort reports
+# ----------------------------------------------------------------------------
+CONSORT_STAGES = ['Screened Patients', 'Consented Patients', 'Patients Reaching Baseline', 'Patients With Surgery',
+                  'Patients Reaching Week 6', 'Patients Reaching Month 3', 'Patients Reaching Month 6']
+DECLINE_REASONS = ['Not interested in research', 'COVID-related', 'Compensation insufficient',
+                   'Specific study procedure', 'Time related', 'No reason provided']
+WITHDRAWAL_REASONS = ['Subject chose to discontinue the study', 'Site PI chose to discontinue subject participation',
+                      'Subject is lost to follow-up, unable to locate', 'Death']
+
+
+def consort_stages(n_stages):
+    ''' Stage names of the consort flow, extended with later follow-up months when n_stages > 7 '''
+    stages = list(CONSORT_STAGES[:n_stages])
+    month = 6
+    while len(stages) < n_stages:
+        month += 3
+        stages.append('Patients Reaching Month {}'.format(month))
+    return stages
+
+
+def make_consort_report(mcc, n_stages=7, extra_reasons=0, screened=5000, seed=0):
+    ''' One MCC's consort report as a (source, target, value) dataframe, shaped like the real files:
+    screened patients decline or consent, then each stage loses some patients to withdrawals or early terminations.
+    extra_reasons adds synthetic dropout reasons to grow the number of nodes.
+    '''
+    rng = np.random.default_rng(seed)
+    stages = consort_stages(n_stages)
+    reasons = WITHDRAWAL_REASONS + ['Synthetic reason {}'.format(i) for i in range(extra_reasons)]
+    rows = []
+    remaining = screened
+    for i, (source, target) in enumerate(zip(stages[:-1], stages[1:])):
+        if i == 0:
+            prefix, stage_reasons = 'Declined', DECLINE_REASONS + reasons[len(WITHDRAWAL_REASONS):]
+        elif i == 1:
+            prefix, stage_reasons = 'Withdrawl Prior to Surgery', reasons
+        else:
+            prefix, stage_reasons = 'Early Terminations', reasons
+        drop_fraction = 0.6 if i == 0 else rng.uniform(0.02, 0.2)
+        dropped = rng.multinomial(int(remaining * drop_fraction), rng.dirichlet(np.ones(len(stage_reasons))))
+        for reason, value in zip(stage_reasons, dropped):
+            if value > 0:
+                rows.append((source, '{} - {}'.format(prefix, reason), int(value)))
+        remaining = remaining - int(dropped.sum())
+        rows.append((source, target, int(remaining)))
+    return pd.DataFrame(rows, columns=['source', 'target', 'value'])
+
+
+def make_consort_table(n_mccs=2, n_stages=7, extra_reasons=0, screened=5000, seed=0):
+    ''' Consort flow table for several MCCs with the source, target, value, mcc schema of the app's data '''
+    frames = []
+    for mcc in range(1, n_mccs + 1):
+        df = make_consort_report(mcc, n_stages, extra_reasons, screened, seed + mcc)
+        df['mcc'] = str(mcc)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_report_files(report='consort', n_mccs=2, n_dates=5, n_stages=7, extra_reasons=0, seed=0):
+    ''' Files of a report directory as served by the TACC files API: {path: bytes}.
+    Includes the per-MCC latest files, one file per MCC for each historical date and the index.json listing them.
+    '''
+    files = {}
+    index = {}
+    dates = pd.date_range('2021-04-01', periods=n_dates, freq='7D').strftime('%Y-%m-%d')
+    for d, selected_date in enumerate(dates):
+        entries = []
+        for mcc in range(1, n_mccs + 1):
+            name = '{}-data-{}-{}.csv'.format(report, mcc, selected_date)
+            df = make_consort_report(mcc, n_stages, extra_reasons, screened=1000 + 100 * d, seed=seed + 1000 * d + mcc)
+            files['/'.join([report, name])] = df.to_csv(header=False, index=False).encode('utf-8')
+            entries.append({'mcc': mcc, 'file': name})
+        index[selected_date] = [{'08:00': entries}]
+    for mcc in range(1, n_mccs + 1):
+        df = make_consort_report(mcc, n_stages, extra_reasons, seed=seed + mcc)
+        files['/'.join([report, '{}-data-{}-latest.csv'.format(report, mcc)])] = df.to_csv(header=False, index=False).encode('utf-8')
+    files['/'.join([report, 'index.json'])] = json.dumps(index).encode('utf-8')
+    return files
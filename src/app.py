@@ -1,57 +1,66 @@
 # ----------------------------------------------------------------------------
 # PYTHON LIBRARIES
 # ----------------------------------------------------------------------------
-
-# File Management
-import os # Operating system library
-import pathlib # file paths
+# Modules only needed by some requests (profiling, Arrow files, HTTP downloads) are imported where they are used.
+# The gunicorn master loads them with warm_imports() before forking, so workers still share them.
 
 # Data Cleaning and transformations
 import pandas as pd
 import numpy as np
-from datetime import datetime
 import json
 
-# Get data from url, with ability to retry
-
-
 # Data visualization
-import plotly.express as px
 import plotly.graph_objects as go
+from plotly.colors import qualitative
+try:
+    import orjson # plotly imports it lazily on first use; importing it here avoids a race between serializing threads
+except ImportError:
+    orjson = None
 
-from flask import Flask
+from flask import Response, g, request
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Dash Framework
 import dash_bootstrap_components as dbc
-from dash import Dash, callback, clientside_callback, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL
+from dash import Dash, html, dcc, dash_table as dt, Input, Output, State, callback_context, no_update
 from dash.exceptions import PreventUpdate
-import dash_daq as daq
-
-from flask import request
 
 # import local modules
-from config_settings import *
-from data_processing import *
+from config_settings import (ASSETS_PATH, REQUESTS_PATHNAME_PREFIX, DATA_SOURCE, CACHE_PATH, CACHE_TTL, CACHE_MAX_BYTES,
+    FIGURE_CACHE_MAX_BYTES, REFRESH_INTERVAL, PREFETCH_DATES, ENABLE_PROFILING, TABLE_PAGE_SIZE,
+    TACC_IFRAME_SIZE, CONTENT_STYLE, export_style, get_django_user)
+from data_processing import (ALL_MCCS, get_history_index, peek_history_index, get_data_files_list, load_data,
+    empty_consort_df, save_dataset, read_dataset, find_dataset, get_dataset_issues, get_latest_snapshot, get_mccs,
+    aggregate_mccs, get_sankey_nodes, get_sankey_dataframe, query_table, stream_csv)
+from caching import LRUCache, DiskCache
+from refresher import start_refresher
+from trends import get_trend_cube
+import metrics
 
 # ----------------------------------------------------------------------------
 # DATA VISUALIZATION
 # ----------------------------------------------------------------------------
 
+NODE_COLORS = qualitative.Plotly
+
 def build_sankey(nodes_dataframe, data_dataframe):
+    # Nodes encoded against a shared index are colored by their shared position, so a node keeps its color in every mcc
+    node_ids = nodes_dataframe['SharedID'] if 'SharedID' in nodes_dataframe else nodes_dataframe['NodeID']
     sankey_fig = go.Figure(data=[go.Sankey(
         # Define nodes
         node = dict(
           pad = 15,
           thickness = 20,
           line = dict(color = "black", width = .5),
-          label =  nodes_dataframe['Node'],
-           # color =  "red"
+          label =  nodes_dataframe['Node'].astype(str).tolist(),
+          color =  [NODE_COLORS[i % len(NODE_COLORS)] for i in node_ids],
         ),
         # Add links
         link = dict(
-          source =  data_dataframe['sourceID'],
-          target =  data_dataframe['targetID'],
-          value =  data_dataframe['value'],
+          source =  data_dataframe['sourceID'].to_numpy(dtype=np.int32).tolist(),
+          target =  data_dataframe['targetID'].to_numpy(dtype=np.int32).tolist(),
+          value =  data_dataframe['value'].to_numpy(dtype=np.int64).tolist(),
           ),
         # orientation = 'v'
     )])
@@ -62,11 +71,11 @@ def build_sankey(nodes_dataframe, data_dataframe):
 # DATA FOR DASH UI COMPONENTS
 # ----------------------------------------------------------------------------
 
-# Data table of API data
-def build_datatable(data_source, table_id):
+# Data table of API data. Rows are served a page at a time by the update_table_page callback
+def build_datatable(data_source, table_id, export_href=None):
     new_datatable =  dt.DataTable(
             id = table_id,
-            data=data_source.to_dict('records'),
+            data=[],
             columns=[{"name": i, "id": i} for i in data_source.columns],
             css=[{'selector': '.row', 'rule': 'margin: 0; flex-wrap: nowrap'},
                 {'selector':'.export','rule':export_style }
@@ -83,9 +92,20 @@ def build_datatable(data_source, table_id):
                 'color': 'white'
             },
 
-            export_format="csv",
+            page_action='custom',
+            page_current=0,
+            page_size=TABLE_PAGE_SIZE,
+            page_count=max(1, -(-len(data_source) // TABLE_PAGE_SIZE)),
+            filter_action='custom',
+            filter_query='',
+            sort_action='custom',
+            sort_mode='multi',
+            sort_by=[],
         )
-    return new_datatable
+    if not export_href:
+        return new_datatable
+    export_link = html.A('Export', href=export_href, className='btn btn-info', style={'margin-top': '10px'})
+    return html.Div([new_datatable, export_link])
 
 def build_dash_content(chart, data_table): # build_sankey(nodes, sankey_df) build_datatable(redcap_df,'table_csv') redcap_df
     dash_content = [
@@ -100,6 +120,163 @@ def build_dash_content(chart, data_table): # build_sankey(nodes, sankey_df) buil
     ]
     return dash_content
 
+def mcc_label(mcc):
+    return 'All sites' if str(mcc) == ALL_MCCS else 'MCC{}'.format(mcc)
+
+def get_mcc_options(mccs):
+    mcc_options = [{'label': mcc_label(ALL_MCCS), 'value': ALL_MCCS}]
+    mcc_options = mcc_options + [{'label': mcc_label(mcc), 'value': str(mcc)} for mcc in mccs]
+    return mcc_options
+
+def build_issues_alert(issues, max_shown=10):
+    ''' Warning listing the issues found by validate_flows, or None if there are none '''
+    if not issues:
+        return None
+    items = [html.Li('{}: {}'.format(mcc_label(issue['mcc']) if issue['mcc'] else 'All sites', issue['detail']))
+             for issue in issues[:max_shown]]
+    if len(issues) > max_shown:
+        items.append(html.Li('and {} more'.format(len(issues) - max_shown)))
+    return dbc.Alert([html.Div('Data checks found {} issue(s) in this report:'.format(len(issues))), html.Ul(items)],
+                     color='warning', dismissable=True)
+
+def build_failures_alert(failures):
+    ''' Error listing the files of the latest data that could not be loaded, or None if there are none '''
+    if not failures:
+        return None
+    items = [html.Li('{}: {} ({})'.format(mcc_label(failure['mcc']), failure['file'], failure['error']))
+             for failure in failures]
+    return dbc.Alert([html.Div('Some files of the latest report could not be loaded. '
+                               'The data shown may be out of date or incomplete:'), html.Ul(items)],
+                     color='danger', dismissable=True)
+
+def build_trend_figure(cube, mcc):
+    ''' Line chart of every link of an mcc across the dates of a TrendCube '''
+    values = cube.mcc_values(mcc)
+    used = np.flatnonzero(values.any(axis=0))
+    labels = cube.link_labels()
+    trend_fig = go.Figure(data=[
+        go.Scatter(x=cube.dates, y=values[:, j].tolist(), mode='lines+markers', name=labels[j])
+        for j in used
+    ])
+    trend_fig.update_layout(title='CONSORT trends for {}'.format(mcc_label(mcc)), legend=dict(font=dict(size=9)))
+    return trend_fig
+
+# ----------------------------------------------------------------------------
+# CACHED FIGURES AND TABLES
+# ----------------------------------------------------------------------------
+# Figures are serialized once and the JSON is shared by all workers through the figure store.
+# Each worker keeps the decoded figure (plain lists and dicts, cheap for Dash to re-encode) in figure_cache.
+_figure_store = None
+
+def get_figure_store():
+    global _figure_store
+    if _figure_store is None:
+        _figure_store = DiskCache(CACHE_PATH.joinpath('figures'), CACHE_MAX_BYTES)
+    return _figure_store
+
+def serialize_figure(fig):
+    ''' Figure as JSON text, using orjson through plotly when it is installed '''
+    with metrics.timed('json_serialize'):
+        return fig.to_json(validate=False)
+
+def selection_size(selection):
+    return selection['json_bytes'] + int(selection['frame'].memory_usage(deep=True).sum())
+
+figure_cache = LRUCache(FIGURE_CACHE_MAX_BYTES, size_func=selection_size)
+node_cache = LRUCache(FIGURE_CACHE_MAX_BYTES // 16, size_func=lambda nodes: int(nodes.memory_usage(deep=True).sum()))
+warm_executor = ThreadPoolExecutor(max_workers=1)
+warmed_versions = set()
+
+def lookup_selection(key):
+    ''' Selection already decoded by this worker, or None '''
+    selection = figure_cache.get(key)
+    if selection is not None:
+        metrics.cache_hit('figures')
+    else:
+        metrics.cache_miss('figures')
+    return selection
+
+def cached_selection(key, frame, build_figure):
+    ''' Figure and table frame for a selection that is not in figure_cache. The figure JSON is read from the
+    shared figure store, or built with build_figure(), serialized and stored there.
+    '''
+    store = get_figure_store()
+    figure_json = store.get(key)
+    if figure_json is None:
+        metrics.cache_miss('figure_store')
+        with metrics.timed('figure_build'):
+            fig = build_figure()
+        figure_json = serialize_figure(fig)
+        store.set(key, figure_json)
+    else:
+        metrics.cache_hit('figure_store')
+    selection = {
+        'figure': json.loads(figure_json),
+        'frame': frame,
+        'json_bytes': len(figure_json),
+    }
+    figure_cache.set(key, selection)
+    return selection
+
+def get_dataset_nodes(df, data_hash):
+    ''' Node index of a whole dataset, factorized once per worker and shared by the figures of every mcc '''
+    nodes = node_cache.get(data_hash)
+    if nodes is None:
+        nodes = get_sankey_nodes(df)
+        node_cache.set(data_hash, nodes)
+    return nodes
+
+def build_selection_figure(selected_df, selected_date, shared_nodes=None):
+    ''' Build the Sankey figure of the rows of one mcc '''
+    if str(selected_date) == 'latest':
+        chart_title = 'CONSORT Report from latest data'
+    else: # historical data from csv loaded to data store
+        chart_title = 'CONSORT Report from {}'.format(selected_date)
+    nodes, sankey_df = get_sankey_dataframe(selected_df, shared_nodes=shared_nodes) # transform data into sankey data format
+    sankey_fig = build_sankey(nodes, sankey_df) # turn sankey data into sankey figure
+    sankey_fig.update_layout(title = chart_title)
+    return sankey_fig
+
+def get_selection(load_df, data_hash, selected_date, mcc):
+    ''' Sankey figure and data table of one mcc of a dataset, cached on (report, date, mcc, content hash).
+    load_df() returns the dataset, and is only called when the selection is not cached yet.
+    mcc ALL_MCCS selects the links of all sites summed together. Returns None if the mcc has no data.
+    '''
+    key = (report, str(selected_date), str(mcc), data_hash)
+    selection = lookup_selection(key)
+    if selection is not None:
+        return selection
+    df = load_df()
+    if df is None or len(df) == 0:
+        return None
+    if str(mcc) == ALL_MCCS:
+        selected_df = aggregate_mccs(df)
+    else:
+        selected_df = df[df['mcc']==str(mcc)].reset_index(drop=True)
+    if len(selected_df) == 0:
+        return None
+    shared_nodes = get_dataset_nodes(df, data_hash)
+    return cached_selection(key, selected_df, lambda: build_selection_figure(selected_df, selected_date, shared_nodes))
+
+def get_trend_selection(cube, mcc):
+    ''' Trend chart and table of link changes since the previous date for one mcc, cached on the cube version '''
+    key = (report, 'trend', str(mcc), cube.version)
+    selection = lookup_selection(key)
+    if selection is not None:
+        return selection
+    if cube.mcc_values(mcc) is None:
+        return None
+    deltas = cube.deltas(mcc)
+    frame = deltas if deltas is not None else pd.DataFrame()
+    return cached_selection(key, frame, lambda: build_trend_figure(cube, mcc))
+
+def warm_selections(df, data_hash, selected_date):
+    ''' Build and cache the figures for every mcc of a dataset in a background thread '''
+    def warm():
+        for mcc in [ALL_MCCS] + get_mccs(df):
+            get_selection(lambda: df, data_hash, selected_date, mcc)
+    return warm_executor.submit(warm)
+
 # ----------------------------------------------------------------------------
 # Sample JSON
 # ----------------------------------------------------------------------------
@@ -107,32 +284,38 @@ latest_data = [{"source": "Screened Patients", "target": "Declined - Not interes
 # ----------------------------------------------------------------------------
 # Data loading parameters
 # ----------------------------------------------------------------------------
-file_url_root ='https://api.a2cps.org/files/v2/download/public/system/a2cps.storage.community/reports'
+tacc_url_root = 'https://api.a2cps.org/files/v2/download/public/system/a2cps.storage.community/reports'
+file_url_root = DATA_SOURCE or tacc_url_root # local directory or archive when DATA_SOURCE is set
 report = 'consort'
 report_suffix = report + '-data-[mcc]-latest.csv'
 mcc_list=[1,2]
 
-latest_data_dict = {'start':'here'}
-global_variable = 'THIS IS GLOBAL'
-
 def load_latest_data(file_url_root, report, report_suffix, mcc_list):
     # Load Data for page
-    latest_files = get_latest_files_list(report_suffix, mcc_list)
-    latest_data = load_data(file_url_root, report, latest_files) # Load data for latest data from url
-    # latest_data = pd.read_csv(os.path.join(ASSETS_PATH, 'latest.csv')) # line to Load from local files for development purposes
-    latest_data_dict = latest_data.to_dict('records')
-    return latest_data_dict
-
-def load_available_files(file_url_root, report):
-    files_df = get_available_files_df(file_url_root, report)
-
-    if not files_df.empty:
-        past_dates = list(files_df['date'].unique())
-    else:
-        past_dates = []
-    past_dates_options = [{'label': d, 'value': d} for d in past_dates]
-
-    return past_dates_options
+    snapshot = get_latest_snapshot(file_url_root, report, report_suffix, mcc_list, CACHE_TTL)
+    if ('latest', snapshot.version) not in warmed_versions:
+        warmed_versions.add(('latest', snapshot.version))
+        warm_selections(read_dataset(snapshot.handle), snapshot.version, 'latest')
+    if snapshot.failures:
+        return dict(snapshot.handle, failures=list(snapshot.failures))
+    return snapshot.handle
+
+def warm_imports():
+    ''' Import the modules that are otherwise loaded on first use. Called by the gunicorn master before it forks
+    the workers, so they share these modules instead of each importing them while serving its first requests.
+    '''
+    import pyarrow # dataset store
+    import aiohttp # downloads from TACC
+    import plotly.io.json # figure and callback serialization, including Dash's first page
+
+def start_background_refresh():
+    ''' Keep the latest data and recent historical dates prefetched in the shared cache '''
+    return start_refresher(REFRESH_INTERVAL, file_url_root, report, report_suffix, mcc_list, PREFETCH_DATES)
+
+def get_date_options(history_index):
+    date_options = [{'label': 'latest', 'value': 'latest'}]
+    date_options = date_options + [{'label': d, 'value': d} for d in history_index.dates()]
+    return date_options
 # ----------------------------------------------------------------------------
 # DASH APP LAYOUT
 # ----------------------------------------------------------------------------
@@ -143,25 +326,23 @@ app = Dash(__name__,
                 meta_tags=[{'name': 'viewport', 'content': 'width=device-width, initial-scale=1'}],
                 assets_folder=ASSETS_PATH,
                 requests_pathname_prefix=REQUESTS_PATHNAME_PREFIX,
+                suppress_callback_exceptions=True, # the data table is created by the show_store_data callback
+                compress=True, # gzip callback responses with Flask-Compress
                 )
 
 def get_layout():
     if not get_django_user():
         return html.H1("Unauthorized")
-    global latest_data_dict
-    latest_data_dict = load_latest_data(file_url_root, report, report_suffix, mcc_list)
-    date_options = [{'label': 'latest', 'value': 'latest'}]
-    past_dates_options = load_available_files(file_url_root, report)
-    if len(past_dates_options) > 0:
-        date_options = date_options + past_dates_options
+    # The shell is built from metadata this process already has; data and the full
+    # list of dates are loaded by callbacks once the page is in the browser.
+    date_options = get_date_options(peek_history_index(file_url_root, report))
     layout =  html.Div([
         html.Div([
             dcc.Loading(
                 id="loading-1",
                 type="default",
                 children=html.Div([
-                    dcc.Store(id='latest_data', data = latest_data_dict),
-                    dcc.Store(id='store_data'),
+                    dcc.Location(id='url'),
                     dcc.Store(id='date_data'),
                     html.Div(id='div_store_data'),
                     html.Div(id='div_test'),
@@ -177,14 +358,10 @@ def get_layout():
                             ),
                         ],id='dd_date',md=2),
                         dbc.Col([
-                            # TO DO: Convert this dropdown to use a list generated from the date selected in the dates dropdown.
+                            # options are replaced with the mccs of the selected date once its data is loaded
                             dcc.Dropdown(
                                 id='dropdown-mcc',
-                                options=[
-                                    {'label': 'MCC1', 'value': '1'},
-                                    {'label': 'MCC2', 'value': '2'}
-                                ],
-
+                                options=get_mcc_options(mcc_list),
                             ),
                         ],id='dd_mcc',md=2),
                     ]),
@@ -193,7 +370,15 @@ def get_layout():
                             html.Div(id="report_msg"),
                         ],md = 9),
                         dbc.Col([
-
+                            dcc.RadioItems(
+                                id='view-mode',
+                                options=[
+                                    {'label': ' Snapshot ', 'value': 'snapshot'},
+                                    {'label': ' Trend ', 'value': 'trend'}
+                                ],
+                                value='snapshot',
+                                inline=True,
+                            ),
                         ],md = 3),
                     ]),
                     html.Div(id = 'dash_content'),
@@ -209,96 +394,186 @@ app.layout = get_layout
 # ----------------------------------------------------------------------------
 # DATA CALLBACKS
 # ----------------------------------------------------------------------------
+# load list of historical dates after the page shell is rendered
+@app.callback(
+    Output('dropdown-date', 'options'),
+    Input('url', 'pathname'),
+    )
+def set_dropdown_dates_options(pathname):
+    if not get_django_user():
+        raise PreventUpdate
+    return get_date_options(get_history_index(file_url_root, report))
+
 # load selected data into data store
 @app.callback(
-    Output('store_data', 'data'),
     Output('date_data', 'data'),
-    # Output('dash_content','children'),
     Input('dropdown-date', 'value'),
-    State('store_data', 'data'),
     )
-def set_dropdown_dates_value(selected_date, store_data):
+def set_dropdown_dates_value(selected_date):
     if not get_django_user():
         raise PreventUpdate
     if not selected_date:
         raise PreventUpdate
     else:
-        global latest_data_dict
-        global global_variable
-
         if selected_date == 'latest':
-            sankey_data = latest_data_dict
-        elif selected_date in store_data.keys():
-            sankey_data = store_data[selected_date]
+            date_handle = load_latest_data(file_url_root, report, report_suffix, mcc_list)
         else:
-            selected_date_files = get_data_files_list(selected_date, files_df)
-            selected_date_data = load_data(file_url_root, report, selected_date_files)
-            if len(selected_date_data) > 0:
-                store_data[str(selected_date)] = selected_date_data.to_dict('records')
-                sankey_data = store_data[str(selected_date)]
-            else:
-                store_data = store_data
-                sankey_data = {}
+            date_handle = find_dataset(report, selected_date)
+            if date_handle is None:
+                selected_date_files = get_data_files_list(selected_date, get_history_index(file_url_root, report))
+                if selected_date_files:
+                    selected_date_data, failures = load_data(file_url_root, report, selected_date_files)
+                else:
+                    selected_date_data = empty_consort_df()
+                if len(selected_date_data) > 0:
+                    date_handle = save_dataset(selected_date_data, report, selected_date)
+                    warm_selections(read_dataset(date_handle), date_handle['key'], selected_date)
+                else:
+                    date_handle = {}
+
+        return date_handle
+
+# list the mccs present in the selected data
+@app.callback(
+    Output('dropdown-mcc', 'options'),
+    Input('date_data', 'data'),
+    )
+def set_dropdown_mcc_options(date_handle):
+    if not get_django_user():
+        raise PreventUpdate
+    df = read_dataset(date_handle)
+    if df is None or len(df) == 0:
+        return get_mcc_options(mcc_list)
+    return get_mcc_options(get_mccs(df))
 
-        return store_data, sankey_data
+# report the files that failed to load and the issues found when the selected data was validated
+@app.callback(
+    Output('report_msg', 'children'),
+    Input('date_data', 'data'),
+    )
+def show_report_messages(date_handle):
+    if not get_django_user():
+        raise PreventUpdate
+    return [build_failures_alert((date_handle or {}).get('failures')),
+            build_issues_alert(get_dataset_issues(date_handle))]
 
 # Load content of page
 @app.callback(
     Output('dash_content','children'),
     Input('dropdown-mcc', 'value'),
+    Input('view-mode', 'value'),
     State('date_data', 'data'),
     State('dropdown-date', 'value'))
-def show_store_data(mcc, date_data, selected_date):
+def show_store_data(mcc, view_mode, date_handle, selected_date):
     if not get_django_user():
         raise PreventUpdate
-    print(selected_date)
-    df_json = date_data
     error_div = html.Div('There is no data available for this selection')
     if not mcc:
         return html.Div('Please select an mcc to view data')
-    if not df_json:
-        print('no df')
+    selection = get_table_selection(mcc, view_mode, date_handle, selected_date)
+    if selection is None and view_mode == 'trend' and get_trend_cube(report) is None:
+        return html.Div('Trend data is being built in the background. Please check back in a few minutes')
+    if selection is None:
         return error_div
+    if view_mode == 'trend':
+        chart = dcc.Graph(id="trend_chart",figure=selection['figure'])
+        export_href = app.get_relative_path('/download/trend.csv?mcc={}'.format(mcc))
     else:
-        df = pd.DataFrame.from_dict(df_json)
-        print(len(df))
-        if len(df) == 0:
-            return error_div
-        else:
-            if str(selected_date) == 'latest':
-                chart_title = 'CONSORT Report from latest data'
-
-            else: # historical data from csv loaded to data store
-                chart_title = 'CONSORT Report from str(selected_date)'
-
-            # selected_df = df[df['mcc'] == str(mcc)]
-            selected_df = df[df['mcc']==str(mcc)] #[df['mcc']==int(mcc)]
-
-            if len(selected_df) > 0:
-                data_table = build_datatable(selected_df,'table_selected')
-                nodes, sankey_df = get_sankey_dataframe(selected_df) # transform data into sankey data format
-                sankey_fig = build_sankey(nodes, sankey_df) # turn sankey data into sankey figure
-                sankey_fig.update_layout(title = chart_title)
-                chart = dcc.Graph(id="sankey_chart",figure=sankey_fig) # create dash component chart from figure
-                dash_content = build_dash_content(chart, data_table) # create page content from variables
-                # dash_content = [data_table]
-                content = html.Div([
-                    html.Div([html.P(str(len(nodes)))]),
-                    data_table,
-                ])
-                return dash_content  #dash_content
-            else:
-                return error_div
-
+        chart = dcc.Graph(id="sankey_chart",figure=selection['figure']) # create dash component chart from cached figure
+        export_href = app.get_relative_path('/download/{}.csv?mcc={}&date={}'.format(date_handle['key'], mcc, selected_date))
+    data_table = build_datatable(selection['frame'], 'table_selected', export_href)
+    dash_content = build_dash_content(chart, data_table) # create page content from variables
+    return dash_content
 
+def get_table_selection(mcc, view_mode, date_handle, selected_date):
+    ''' Cached figure and table frame for the current selection, or None if there is no data '''
+    if view_mode == 'trend':
+        cube = get_trend_cube(report) # only built by the refresher
+        return get_trend_selection(cube, mcc) if cube is not None and len(cube) > 0 else None
+    if not date_handle or 'key' not in date_handle:
+        return None
+    # page, sort and filter events are usually served from the cached selection without reading the dataset
+    return get_selection(lambda: read_dataset(date_handle), date_handle['key'], selected_date, mcc)
+
+# Serve one page of the data table, filtered and sorted on the server. A new filter goes back to the first page
+@app.callback(
+    Output('table_selected', 'data'),
+    Output('table_selected', 'page_count'),
+    Output('table_selected', 'page_current'),
+    Input('table_selected', 'page_current'),
+    Input('table_selected', 'page_size'),
+    Input('table_selected', 'sort_by'),
+    Input('table_selected', 'filter_query'),
+    State('dropdown-mcc', 'value'),
+    State('view-mode', 'value'),
+    State('date_data', 'data'),
+    State('dropdown-date', 'value'))
+def update_table_page(page_current, page_size, sort_by, filter_query, mcc, view_mode, date_handle, selected_date):
+    if not get_django_user():
+        raise PreventUpdate
+    selection = get_table_selection(mcc, view_mode, date_handle, selected_date) if mcc else None
+    if selection is None:
+        raise PreventUpdate
+    filter_changed = 'table_selected.filter_query' in [t['prop_id'] for t in callback_context.triggered]
+    if filter_changed:
+        page_current = 0
+    page, page_count = query_table(selection['frame'], filter_query, sort_by, page_current or 0, page_size or TABLE_PAGE_SIZE)
+    return page.to_dict('records'), page_count, 0 if filter_changed else no_update
 
+# ----------------------------------------------------------------------------
+# INSTRUMENTATION
+# ----------------------------------------------------------------------------
+@app.server.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if ENABLE_PROFILING and (request.args.get('profile') == '1' or request.cookies.get('profile') == '1'):
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.server.after_request
+def record_request_time(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        import io
+        import pstats
+        stats_output = io.StringIO()
+        pstats.Stats(profiler, stream=stats_output).sort_stats('cumulative').print_stats(25)
+        print('Profile of {} {}\n{}'.format(request.method, request.path, stats_output.getvalue()))
+    if 'request_start' in g and request.endpoint != 'metrics':
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('a2cps_request_seconds', time.perf_counter() - g.request_start, path=route)
+    return response
+
+@app.server.route('/download/<key>.csv')
+def download_table(key):
+    ''' Stream the full table of a selection as csv '''
+    if not get_django_user():
+        return Response('Unauthorized', status=401)
+    mcc = request.args.get('mcc')
+    if key != 'trend' and not all(c in '0123456789abcdef' for c in key):
+        return Response('Unknown dataset', status=404)
+    if key == 'trend':
+        selection = get_table_selection(mcc, 'trend', None, None)
+    else:
+        selection = get_table_selection(mcc, 'snapshot', {'key': key}, request.args.get('date'))
+    if selection is None:
+        return Response('There is no data available for this selection', status=404)
+    filename = '{}-{}-mcc{}.csv'.format(report, request.args.get('date', key), mcc)
+    return Response(stream_csv(selection['frame']), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
 
+@app.server.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
 
 # ----------------------------------------------------------------------------
 # RUN APPLICATION
 # ----------------------------------------------------------------------------
 
 if __name__ == '__main__':
+    start_background_refresh()
     app.run_server(debug=True, port = 8040)
 else:
     server = app.server
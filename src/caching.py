@@ -0,0 +1,248 @@
+# File Management
+import os # Operating system library
+import hashlib
+import pickle
+import string
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------------
+# DISK CACHE SHARED BY ALL WORKER PROCESSES
+# ----------------------------------------------------------------------------
+
+class DiskCache:
+    ''' Size-bounded key/value cache stored as one pickle file per key in a local directory.
+    Every gunicorn worker on the host sees the same directory, so an entry written by one worker is
+    available to all of them.  Writes are atomic (temp file + rename) and reads refresh the file mtime,
+    which is used to evict the least recently used entries once the directory grows past max_bytes.
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.pkl')
+
+    def get(self, key, default=None):
+        ''' Return the value stored for key, or default if it is missing or unreadable '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return default
+        if stored_key != key:
+            return default
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        ''' Store value for key, then evict old entries if the cache is over its size limit '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        ''' Remove least recently used entries until the directory fits in max_bytes '''
+        evict_lru_files(self.directory, '.pkl', self.max_bytes)
+
+
+def evict_lru_files(directory, suffix, max_bytes):
+    ''' Delete the files ending in suffix with the oldest mtime until their total size fits in max_bytes '''
+    entries = []
+    total = 0
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(suffix):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+    if total <= max_bytes:
+        return
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_bytes:
+            break
+
+# ----------------------------------------------------------------------------
+# COLUMNAR DATAFRAME STORE
+# ----------------------------------------------------------------------------
+
+def frame_size(df):
+    return int(df.memory_usage(deep=True).sum())
+
+class ColumnarStore:
+    ''' Size-bounded store of dataframes saved as Arrow IPC files in a local directory, shared by all workers.
+    Converting an Arrow table to pandas copies it, so each process also keeps the dataframes it has read in an
+    LRU cache of up to memory_max_bytes. Keys are content hashes, so a cached dataframe never goes stale; callers
+    must not modify the dataframes they get. Categorical columns round trip as Arrow dictionary arrays.
+    pyarrow is imported on first use.
+    '''
+    def __init__(self, directory, max_bytes, memory_max_bytes=0):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self._frames = LRUCache(memory_max_bytes, size_func=frame_size)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        ''' File of a key, or None if the key is not a hex digest.
+        Keys come back from the browser in dataset handles, so anything else could name a path outside the store.
+        '''
+        key = str(key)
+        if not key or key.strip(string.hexdigits):
+            return None
+        return os.path.join(self.directory, key + '.arrow')
+
+    def __contains__(self, key):
+        path = self._path(key)
+        return path is not None and os.path.exists(path)
+
+    def get(self, key, default=None):
+        import pyarrow as pa
+        path = self._path(key)
+        if path is None:
+            return default
+        df = self._frames.get(key)
+        if df is None:
+            try:
+                with pa.memory_map(path, 'r') as source:
+                    table = pa.ipc.open_file(source).read_all()
+            except (OSError, pa.ArrowInvalid):
+                return default
+            df = table.to_pandas()
+            self._frames.set(key, df)
+        try:
+            os.utime(path, None) # also on memory hits, so the file is not evicted while in use
+        except OSError:
+            pass
+        return df
+
+    def set(self, key, df):
+        import pyarrow as pa
+        path = self._path(key)
+        if path is None:
+            raise ValueError('Dataset keys must be hex digests, got {!r}'.format(key))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            with pa.OSFile(tmp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        evict_lru_files(self.directory, '.arrow', self.max_bytes)
+
+# ----------------------------------------------------------------------------
+# IN-MEMORY LRU CACHE
+# ----------------------------------------------------------------------------
+
+class LRUCache:
+    ''' Thread-safe least recently used cache bounded by the approximate size of its values.
+    size_func(value) returns the size in bytes charged against max_bytes for each entry.
+    '''
+    def __init__(self, max_bytes, size_func=len):
+        self.max_bytes = max_bytes
+        self.size_func = size_func
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def set(self, key, value):
+        size = self.size_func(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._total += size
+            while self._total > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total -= evicted_size
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# ----------------------------------------------------------------------------
+# IN-MEMORY TTL CACHE
+# ----------------------------------------------------------------------------
+
+class TTLCache:
+    ''' Thread-safe cache of at most max_entries values that each expire ttl seconds after being set '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if time.time() >= expires:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._entries)
+
+_MISSING = object()
@@ -1,6 +1,13 @@
 # File Management
 import os # Operating system library
+import json
 import pathlib # file paths
+import tempfile
+import time
+
+from flask import request
+
+from caching import TTLCache
 
 # ----------------------------------------------------------------------------
 # CONFIG SETTINGS
@@ -9,13 +16,64 @@ DATA_PATH = pathlib.Path(__file__).parent.joinpath("data")
 ASSETS_PATH = pathlib.Path(__file__).parent.joinpath("assets")
 REQUESTS_PATHNAME_PREFIX = os.environ.get("REQUESTS_PATHNAME_PREFIX", "/")
 
+# Root of the consort reports. Empty for the TACC files API, otherwise a local directory or a .zip / .tar / .tar.gz
+# archive laid out like the TACC reports folder. DATA_SOURCE=local reads DATA_PATH.
+DATA_SOURCE = os.environ.get("DATA_SOURCE", "")
+if DATA_SOURCE == "local":
+    DATA_SOURCE = str(DATA_PATH)
+
+# ----------------------------------------------------------------------------
+# CACHE SETTINGS
+# ----------------------------------------------------------------------------
+# Shared on-disk cache for files downloaded from the TACC files API
+CACHE_PATH = pathlib.Path(os.environ.get("CACHE_PATH", os.path.join(tempfile.gettempdir(), "a2cps_sankey_cache")))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 300)) # seconds before a cached file is revalidated with the server
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Loaded datasets, kept on the server so the browser only holds small handles
+DATASET_CACHE_MAX_BYTES = int(os.environ.get("DATASET_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Decoded datasets kept in memory, per worker process
+DATASET_MEMORY_MAX_BYTES = int(os.environ.get("DATASET_MEMORY_MAX_BYTES", 128 * 1024 * 1024))
+# In-memory cache of built Sankey figures and tables, per worker process
+FIGURE_CACHE_MAX_BYTES = int(os.environ.get("FIGURE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Background refresh of index.json and report files (0 disables the refresher)
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 300)) # seconds between polls
+PREFETCH_DATES = int(os.environ.get("PREFETCH_DATES", 10)) # number of most recent historical dates to prefetch
+
+# ----------------------------------------------------------------------------
+# HTTP SETTINGS
+# ----------------------------------------------------------------------------
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5)) # seconds, doubled on each retry
+HTTP_TOTAL_TIMEOUT = float(os.environ.get("HTTP_TOTAL_TIMEOUT", 60)) # seconds for a request with all of its retries
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 8)) # open connections per process, shared by all its threads
+
+# ----------------------------------------------------------------------------
+# INSTRUMENTATION SETTINGS
+# ----------------------------------------------------------------------------
+# When enabled, requests with a profile=1 query parameter or cookie are run under cProfile
+ENABLE_PROFILING = os.environ.get("ENABLE_PROFILING", "").lower() in ("1", "true", "yes")
+
+# ----------------------------------------------------------------------------
+# AUTHORIZATION CACHE SETTINGS
+# ----------------------------------------------------------------------------
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60)) # seconds a successful user lookup is reused
+AUTH_CACHE_NEGATIVE_TTL = float(os.environ.get("AUTH_CACHE_NEGATIVE_TTL", 10)) # seconds a failed lookup is reused
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", 1024))
+
 # ----------------------------------------------------------------------------
 # SECURITY FUNCTION
 # ----------------------------------------------------------------------------
+auth_cache = TTLCache(AUTH_CACHE_MAX_ENTRIES)
+_NOT_CACHED = object() # auth_cache.get default, since None is a cached failed login
+
 def get_django_user():
     """
     Utility function to retrieve logged in username
-    from Django
+    from Django. Results are cached per session cookie for AUTH_CACHE_TTL seconds,
+    and failed lookups for AUTH_CACHE_NEGATIVE_TTL seconds.
     """
     DJANGO_LOGIN_API = os.environ.get("DJANGO_LOGIN_API", None)
     DJANGO_SESSION_COOKIE = os.environ.get("DJANGO_SESSION_COOKIE", None)
@@ -30,26 +88,53 @@ def get_django_user():
         if not session_id:
             print("Request cookies: ", request.cookies)
             raise Exception("{cookie} cookie is missing".format(cookie=DJANGO_SESSION_COOKIE))
+    except Exception as e:
+        print(e)
+        return None
+
+    # imported here because these modules read their settings from this module
+    from http_client import http_get
+    import metrics
+
+    cache_key = (DJANGO_LOGIN_API, session_id)
+    # one lookup: an entry could expire between a separate 'in' check and get()
+    cached_user = auth_cache.get(cache_key, _NOT_CACHED)
+    if cached_user is not _NOT_CACHED:
+        metrics.cache_hit('auth')
+        return cached_user
+
+    metrics.cache_miss('auth')
+    auth_start = time.perf_counter()
+    try:
         api = "{django_login_api}".format(
             django_login_api=DJANGO_LOGIN_API
         )
-        response = requests.get(
+        response = http_get(
             api,
             headers = {
                 'cookie': '{cookie}={session_id}'.format(
                     cookie=DJANGO_SESSION_COOKIE,
                     session_id=session_id
                 )
-            }
+            },
         )
-        return response.json()
+        if response.status_code != 200:
+            raise Exception("Login API returned status {}".format(response.status_code))
+        user = json.loads(response.content)
     except Exception as e:
         print(e)
-        return None
+        user = None
+    metrics.observe('a2cps_stage_seconds', time.perf_counter() - auth_start, stage='auth')
+    if user:
+        auth_cache.set(cache_key, user, AUTH_CACHE_TTL)
+    else:
+        auth_cache.set(cache_key, None, AUTH_CACHE_NEGATIVE_TTL)
+    return user
 
 # ----------------------------------------------------------------------------
 # STYLING
 # ----------------------------------------------------------------------------
+TABLE_PAGE_SIZE = 25 # rows sent to the browser per data table page
 
 TACC_IFRAME_SIZE = {
     "max-width" : "1060px", "max-height" : "980px" # THESE ARE SET TO FIT IN THE 1080x1000 TACC iFRAME.  CAN BE REMOVED IF THOSE CONSTRAINTS COME OFF
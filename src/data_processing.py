@@ -1,18 +1,33 @@
 # Data Loading
 import json
 import pandas as pd
-import os
 import io
+import re
 import numpy as np
-import datetime
+import hashlib
+import threading
+import time
+from collections import namedtuple
 
 # Data reqeuests
-import requests
+import http_client
+import local_client
+
+# import local modules
+from config_settings import CACHE_PATH, CACHE_MAX_BYTES, DATASET_CACHE_MAX_BYTES, DATASET_MEMORY_MAX_BYTES
+from caching import DiskCache, ColumnarStore
+import metrics
 
 # ----------------------------------------------------------------------------
 # Load Data from TACC
 # ----------------------------------------------------------------------------
 
+def get_client(file_url_root):
+    ''' Module that reads the files of a report root: local_client for a local directory or archive mirroring
+    the TACC reports, http_client for the TACC files API. Both provide fetch_url and fetch_many.
+    '''
+    return local_client if local_client.is_local(file_url_root) else http_client
+
 def get_latest_files_list(report_suffix, mcc_list):
     ''' Generate a list of the available latest files using the logic by which they should be made available'''
     data_files = []
@@ -21,93 +36,566 @@ def get_latest_files_list(report_suffix, mcc_list):
         data_files.append({str(mcc) : filename})
     return data_files
 
-def get_available_files_df(file_url_root, report):
-    ''' If reoirt index is available, generate list of historical records that are available.
-    If there is an error on the request, simply return None.
+class HistoryIndex:
+    ''' Historical files of a report, parsed from its index.json.
+    files_df holds one row per (date, mcc) with the file from the latest time of that date, and the lookups
+    from date and (date, mcc) to files are built once when the index is parsed.
+    '''
+    def __init__(self, files_df):
+        self.files_df = files_df
+        self._files = dict(zip(zip(files_df['date'], files_df['mcc']), files_df['file']))
+        self._files_by_date = {}
+        for date, mcc, file in zip(files_df['date'], files_df['mcc'], files_df['file']):
+            self._files_by_date.setdefault(date, []).append({mcc: file})
+        self._dates = list(self._files_by_date.keys())
+
+    @classmethod
+    def from_json(cls, i):
+        ''' Parse index.json content: {date: [{time: [{'mcc': mcc, 'file': file}, ...]}, ...]} '''
+        records = [(date, time, str(entry['mcc']), entry['file'])
+                   for date, date_entries in i.items()
+                   for time_entries in date_entries
+                   for time, files in time_entries.items()
+                   for entry in (files if isinstance(files, list) else [files])]
+        files_df = pd.DataFrame.from_records(records, columns=['date', 'time', 'mcc', 'file'])
+        files_df = files_df.sort_values(['date','time','mcc'], ascending=[False, False, True])
+        files_df = files_df.drop_duplicates(['date','mcc']).reset_index(drop=True)
+        return cls(files_df)
+
+    def __len__(self):
+        return len(self._dates)
+
+    def dates(self):
+        ''' Available dates, most recent first '''
+        return list(self._dates)
+
+    def get_file(self, selected_date, mcc):
+        return self._files.get((str(selected_date), str(mcc)))
+
+    def files_for_date(self, selected_date):
+        ''' List of {mcc: file} for a date, in the format used by load_data '''
+        return list(self._files_by_date.get(str(selected_date), []))
+
+EMPTY_HISTORY_INDEX = HistoryIndex(pd.DataFrame(columns=['date', 'time', 'mcc', 'file']))
+_history_indexes = {}
+
+def get_history_index(file_url_root, report, ttl=None):
+    ''' Return the HistoryIndex of a report.
+    index.json is fetched through the revalidating file cache and only re-parsed when its content changes.
+    Returns an empty index if the file is unavailable.
     '''
     index_url = '/'.join([file_url_root, report,'index.json'])
-    i_request = requests.get(index_url)
-    if i_request != 200:
-        # print(i_request.status_code)
-        return pd.DataFrame()
-    else:
-        i = i_request.json()
-        df = pd.DataFrame.from_dict({(a,b): i[a][0][b]
-                               for a in i.keys()
-                               for b in i[a][0].keys()}
-                                 ,orient='index'
-                               )
-        df[['date', 'time']] = pd.DataFrame(df.index.to_list(), index=df.index)
-        df['mcc'] = df.apply(lambda x: x[0]['mcc'], axis=1)
-        df['file'] = df.apply(lambda x: x[0]['file'], axis=1)
-        df.rename(columns={0:'files_dict'}, inplace=True)
-        df = df.sort_values(['date','time'], ascending=False).drop_duplicates(['date','mcc'])
-        return df
+    i_content = get_client(file_url_root).fetch_url(index_url, ttl, stage='index_fetch')
+    if not i_content:
+        return EMPTY_HISTORY_INDEX
+    content_hash = hashlib.sha1(i_content).hexdigest()
+    cached = _history_indexes.get(index_url)
+    if cached and cached[0] == content_hash:
+        return cached[1]
+    try:
+        history_index = HistoryIndex.from_json(json.loads(i_content))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        print('Unable to parse {}: {}'.format(index_url, e))
+        return EMPTY_HISTORY_INDEX
+    _history_indexes[index_url] = (content_hash, history_index)
+    return history_index
+
+def peek_history_index(file_url_root, report):
+    ''' Return the HistoryIndex already parsed by this process, without any network access '''
+    index_url = '/'.join([file_url_root, report,'index.json'])
+    cached = _history_indexes.get(index_url)
+    return cached[1] if cached else EMPTY_HISTORY_INDEX
 
+def get_available_files_df(file_url_root, report):
+    ''' If report index is available, generate dataframe of historical records that are available.
+    If there is an error on the request, return an empty dataframe.
+    '''
+    return get_history_index(file_url_root, report).files_df
 
-def get_data_files_list(selected_date, available_files_df):
-    '''For a selected date, use the available files dataframe to generate a list of available files for that date '''
-    if available_files_df:
-        data_files = []
-        mcc_list = available_files_df[(available_files_df['date']==selected_date)]['mcc'].unique()
-        for mcc in mcc_list:
-            mcc= str(mcc)
-            data_files.append({mcc: available_files_df.iloc[0]['file']})
+def get_data_files_list(selected_date, history_index):
+    '''For a selected date, use the history index to generate a list of available files for that date '''
+    data_files = history_index.files_for_date(selected_date)
+    if data_files:
         return data_files
     else:
         return None
 
+CONSORT_COLUMNS = ['source','target','value', 'mcc']
+CONSORT_CATEGORICAL_COLUMNS = ['source','target','mcc']
+
+def empty_consort_df():
+    ''' Empty consort dataframe with the same column dtypes as loaded data '''
+    df = pd.DataFrame({'source': pd.Series([], dtype='object'),
+                       'target': pd.Series([], dtype='object'),
+                       'value': pd.Series([], dtype='int64'),
+                       'mcc': pd.Series([], dtype='object')})
+    return df.astype({col: 'category' for col in CONSORT_CATEGORICAL_COLUMNS})
+
+def parse_consort_csv(csv_content):
+    ''' Parse the raw bytes of a consort csv (source, target, value without a header row) '''
+    return pd.read_csv(io.BytesIO(csv_content), usecols=[0,1,2], header=None,
+                       names=['source','target','value'],
+                       dtype={'source': 'object', 'target': 'object', 'value': 'int64'})
+
+def ingest_consort_files(mcc_contents):
+    ''' Parse a list of (mcc, file, content) tuples into a single consort dataframe.
+    Files are parsed straight from bytes and concatenated once at the end. Rows without a source or target are
+    dropped. Returns the dataframe and a list of {'mcc', 'file', 'error'} dicts for files that could not be
+    downloaded or parsed, or that had rows dropped.
+    '''
+    frames = []
+    failures = []
+    for mcc, file, csv_content in mcc_contents:
+        if csv_content is None:
+            failures.append({'mcc': str(mcc), 'file': file, 'error': 'file could not be downloaded'})
+            continue
+        try:
+            csv_df = parse_consort_csv(csv_content)
+        except (ValueError, pd.errors.ParserError, UnicodeDecodeError) as e:
+            failures.append({'mcc': str(mcc), 'file': file, 'error': str(e)})
+            continue
+        missing = csv_df['source'].isna() | csv_df['target'].isna()
+        if missing.any():
+            # kept as a file failure so the rows that were left out are reported with the others
+            failures.append({'mcc': str(mcc), 'file': file,
+                             'error': '{} rows with a missing source or target were dropped'.format(int(missing.sum()))})
+            csv_df = csv_df[~missing]
+        csv_df['mcc'] = str(mcc)
+        frames.append(csv_df)
+
+    if not frames:
+        return empty_consort_df(), failures
+    df = pd.concat(frames, ignore_index=True)
+    df = df.astype({col: 'category' for col in CONSORT_CATEGORICAL_COLUMNS})
+    return df[CONSORT_COLUMNS], failures
+
+ALL_MCCS = 'all' # mcc value of the links of all sites summed together
+
+def aggregate_mccs(df):
+    ''' Links of all mccs in a consort dataframe summed over (source, target), with mcc set to ALL_MCCS '''
+    totals = df.groupby(['source', 'target'], observed=True, sort=False)['value'].sum().reset_index()
+    totals['mcc'] = ALL_MCCS
+    return totals[CONSORT_COLUMNS]
+
+def get_mccs(df):
+    ''' mccs present in a consort dataframe, in numeric order where possible '''
+    mccs = [str(mcc) for mcc in df['mcc'].unique()]
+    return sorted(mccs, key=lambda mcc: (0, int(mcc), mcc) if mcc.isdigit() else (1, 0, mcc))
+
+def dataset_hash(df):
+    ''' Content hash of a consort dataframe, used as part of cache keys '''
+    row_hashes = pd.util.hash_pandas_object(df[CONSORT_COLUMNS].astype(str), index=False)
+    return hashlib.sha1(row_hashes.to_numpy().tobytes()).hexdigest()
+
 def load_data(file_url_root, report, files_list):
-    '''Load data for a specified file. Handle 500 server errors'''
-    cosort_columns = ['source','target','value', 'mcc']
-    df = pd.DataFrame(columns=cosort_columns)
-    for f in files_list:
-        for mcc in f.keys():
-            file = f[mcc]
-            csv_url = '/'.join([file_url_root, report, file])
-            csv_request = requests.get(csv_url)
-            # print(csv_request.status_code)
-            csv_content = csv_request.content
-            try:
-                csv_df = pd.read_csv(io.StringIO(csv_content.decode('utf-8')), usecols=[0,1,2], header=None)
-                csv_df['mcc'] = mcc
-                csv_df.columns = cosort_columns
-            except:
-                csv_df = pd.DataFrame(columns=cosort_columns)
-            df = pd.concat([df,csv_df])
-    return df
+    '''Load data for the files in files_list ([{mcc: file}, ...]).
+    Returns the combined dataframe and a list of the files that failed to download or parse.
+    '''
+    mcc_files = [(mcc, f[mcc]) for f in files_list for mcc in f.keys()]
+    csv_urls = ['/'.join([file_url_root, report, file]) for mcc, file in mcc_files]
+    csv_contents = get_client(file_url_root).fetch_many(csv_urls, stage='csv_fetch', labels=[{'mcc': mcc} for mcc, file in mcc_files])
+    with metrics.timed('parse'):
+        df, failures = ingest_consort_files(
+            [(mcc, file, csv_content) for (mcc, file), csv_content in zip(mcc_files, csv_contents)])
+    for failure in failures:
+        print('Unable to load {file} for MCC {mcc}: {error}'.format(**failure))
+    return df, failures
+
+
+# ----------------------------------------------------------------------------
+# Flow validation and repair
+# ----------------------------------------------------------------------------
+# Checks run on the whole consort dataframe at once: per-label and per-node totals come from groupbys, and
+# only the (small) set of unique labels and links is handled in python.
+
+def normalize_label(label):
+    return ' '.join(str(label).split()).casefold()
+
+def used_labels(column):
+    ''' Labels that appear in a source or target column '''
+    return pd.Index(np.asarray(column.unique(), dtype=object))
+
+def label_totals(df):
+    ''' Total inflow and outflow of every label over all mccs, indexed by label '''
+    inflow = df.groupby('target', observed=True)['value'].sum()
+    outflow = df.groupby('source', observed=True)['value'].sum()
+    inflow.index = inflow.index.astype(object)
+    outflow.index = outflow.index.astype(object)
+    totals = pd.concat([inflow.rename('inflow'), outflow.rename('outflow')], axis=1)
+    return totals.fillna(0).astype('int64')
+
+def canonical_label_map(df):
+    ''' Map of misspelled node labels to the label of the node they refer to.
+    Labels that differ only in case or spacing are merged into the spelling carrying the most patients. A label
+    with outflow but no inflow (other than the root of the flow) is mapped to the only other label that ends
+    with it, e.g. "Reaching Month 3" to "Patients Reaching Month 3".
+    '''
+    totals = label_totals(df)
+    if len(totals) == 0:
+        return {}
+    weight = totals['inflow'] + totals['outflow']
+    normalized = pd.Series([normalize_label(label) for label in totals.index], index=totals.index)
+    label_map = {}
+    for _, group in weight.groupby(normalized.to_numpy()):
+        if len(group) > 1:
+            canonical = group.idxmax()
+            label_map.update({label: canonical for label in group.index if label != canonical})
+
+    canonical_totals = totals.groupby(lambda label: label_map.get(label, label)).sum()
+    unreached = canonical_totals[(canonical_totals['inflow'] == 0) & (canonical_totals['outflow'] > 0)]
+    canonical_normalized = {label: normalize_label(label) for label in canonical_totals.index}
+    orphans = unreached.index.drop(unreached['outflow'].idxmax()) if len(unreached) else []
+    for orphan in orphans:
+        suffix = ' ' + canonical_normalized[orphan]
+        matches = [label for label, norm in canonical_normalized.items()
+                   if label != orphan and norm.endswith(suffix) and canonical_totals.at[label, 'inflow'] > 0]
+        if len(matches) == 1:
+            label_map.update({label: matches[0] for label, canonical in list(label_map.items()) if canonical == orphan})
+            label_map[orphan] = matches[0]
+    return label_map
+
+def relabel(column, label_map):
+    ''' Categorical column with labels renamed by label_map, renaming only the categories '''
+    column = column.astype('category')
+    renamed = np.array([label_map.get(label, label) for label in column.cat.categories], dtype=object)
+    category_codes, categories = pd.factorize(renamed)
+    codes = column.cat.codes.to_numpy()
+    return pd.Categorical.from_codes(np.where(codes >= 0, category_codes[codes], -1), categories=categories)
+
+def find_cycle_nodes(source_ids, target_ids, n_nodes):
+    ''' Nodes on a cycle, or only reachable through one. Nodes without inflow are peeled off layer by layer;
+    whatever is left when no such node remains cannot be ordered from the root to the leaves.
+    '''
+    alive = np.ones(n_nodes, dtype=bool)
+    live_edges = np.ones(len(source_ids), dtype=bool)
+    while True:
+        indegree = np.bincount(target_ids[live_edges], minlength=n_nodes)
+        layer = alive & (indegree == 0)
+        if not layer.any():
+            return np.flatnonzero(alive)
+        alive &= ~layer
+        live_edges &= ~layer[source_ids]
+
+def flow_issue(check, mcc, detail):
+    return {'check': check, 'mcc': mcc, 'detail': detail}
+
+def validate_flows(df):
+    ''' Repair node labels of a consort dataframe and check the flow of every mcc.
+    Returns the repaired dataframe and a list of {'check', 'mcc', 'detail'} dicts describing what was repaired
+    (check 'label') and what could not be: nodes without inflow besides the root ('orphan'), nodes with more
+    patients leaving than arriving ('conservation') and links that loop back ('cycle').
+    '''
+    issues = []
+    if len(df) == 0:
+        return df, issues
+    with metrics.timed('validate'):
+        label_map = canonical_label_map(df)
+        if label_map:
+            df = df.copy()
+            df['source'] = relabel(df['source'], label_map)
+            df['target'] = relabel(df['target'], label_map)
+            df = df.groupby(['source', 'target', 'mcc'], observed=True, sort=False)['value'].sum().reset_index()[CONSORT_COLUMNS]
+            issues += [flow_issue('label', None, '"{}" renamed to "{}"'.format(label, canonical))
+                       for label, canonical in sorted(label_map.items())]
+
+        inflow = df.groupby(['mcc', 'target'], observed=True)['value'].sum()
+        outflow = df.groupby(['mcc', 'source'], observed=True)['value'].sum()
+        inflow.index.names = outflow.index.names = ['mcc', 'node']
+        inflow.index = inflow.index.set_levels([level.astype(object) for level in inflow.index.levels])
+        outflow.index = outflow.index.set_levels([level.astype(object) for level in outflow.index.levels])
+        nodes = pd.concat([inflow.rename('inflow'), outflow.rename('outflow')], axis=1).fillna(0).astype('int64')
+        nodes = nodes.reset_index()
+
+        unreached = nodes[(nodes['inflow'] == 0) & (nodes['outflow'] > 0)]
+        roots = unreached.groupby('mcc')['outflow'].idxmax()
+        for row in unreached.drop(roots.to_numpy()).itertuples():
+            issues.append(flow_issue('orphan', row.mcc, '"{}" has {} patients leaving but none arriving'.format(row.node, row.outflow)))
+        excess = nodes[(nodes['inflow'] > 0) & (nodes['outflow'] > nodes['inflow'])]
+        for row in excess.itertuples():
+            issues.append(flow_issue('conservation', row.mcc, '"{}" has {} patients leaving but only {} arriving'.format(row.node, row.outflow, row.inflow)))
+
+        labels, source_ids, target_ids = encode_sankey_links(df)
+        n_nodes = len(labels)
+        links = pd.unique(source_ids.astype(np.int64) * n_nodes + target_ids) # each distinct link once
+        cycle_nodes = find_cycle_nodes(links // n_nodes, links % n_nodes, n_nodes)
+        if len(cycle_nodes):
+            issues.append(flow_issue('cycle', None, 'links between {} form a cycle'.format(
+                ', '.join('"{}"'.format(label) for label in labels[cycle_nodes]))))
+    return df, issues
+
+
+# ----------------------------------------------------------------------------
+# Server side data store
+# ----------------------------------------------------------------------------
+_dataset_store = None
+_dataset_dates = None
+_dataset_issues = None
+
+def get_dataset_store():
+    ''' Return the on-disk columnar store of loaded datasets shared by all worker processes.
+    Each process keeps the datasets it has decoded in memory, up to DATASET_MEMORY_MAX_BYTES.
+    '''
+    global _dataset_store
+    if _dataset_store is None:
+        _dataset_store = ColumnarStore(CACHE_PATH.joinpath('datasets'), DATASET_CACHE_MAX_BYTES, DATASET_MEMORY_MAX_BYTES)
+    return _dataset_store
+
+def get_dataset_dates():
+    ''' Return the on-disk map of (report, date) to dataset key '''
+    global _dataset_dates
+    if _dataset_dates is None:
+        _dataset_dates = DiskCache(CACHE_PATH.joinpath('dataset_dates'), CACHE_MAX_BYTES)
+    return _dataset_dates
+
+def get_dataset_issues_store():
+    ''' Return the on-disk map of dataset key to the issues found by validate_flows '''
+    global _dataset_issues
+    if _dataset_issues is None:
+        _dataset_issues = DiskCache(CACHE_PATH.joinpath('dataset_issues'), CACHE_MAX_BYTES)
+    return _dataset_issues
+
+def save_dataset(df, report, selected_date):
+    ''' Store a loaded dataset on the server and return the small handle that is sent to the browser.
+    The dataset key is the content hash of the loaded data, so reloading identical data does not add a new entry,
+    and the data is validated and repaired (see validate_flows) only the first time it is stored. Read the data
+    back with read_dataset to get the repaired version.
+    '''
+    key = dataset_hash(df)
+    store = get_dataset_store()
+    issues_store = get_dataset_issues_store()
+    if key not in store or key not in issues_store:
+        repaired_df, issues = validate_flows(df)
+        store.set(key, repaired_df)
+        issues_store.set(key, issues)
+    get_dataset_dates().set((report, str(selected_date)), key)
+    return {'report': report, 'date': str(selected_date), 'key': key}
+
+def read_dataset(handle):
+    ''' Return the dataset for a handle created by save_dataset, or None if it is not available '''
+    if not handle or 'key' not in handle:
+        return None
+    return get_dataset_store().get(handle['key'])
+
+def get_dataset_issues(handle):
+    ''' Issues found when the dataset of a handle was validated, or an empty list '''
+    if not handle or 'key' not in handle:
+        return []
+    return get_dataset_issues_store().get(handle['key'], [])
+
+def find_dataset(report, selected_date):
+    ''' Return the handle of a dataset already loaded for a report date, or None '''
+    key = get_dataset_dates().get((report, str(selected_date)))
+    if key is None or key not in get_dataset_store():
+        metrics.cache_miss('datasets')
+        return None
+    metrics.cache_hit('datasets')
+    return {'report': report, 'date': str(selected_date), 'key': key}
+
+
+# ----------------------------------------------------------------------------
+# Latest report snapshots
+# ----------------------------------------------------------------------------
+# Immutable record of the latest data of a report. version is the dataset key (content hash)
+ReportSnapshot = namedtuple('ReportSnapshot', ['report', 'version', 'loaded', 'handle', 'failures'])
+
+_snapshots = {}
+_snapshot_locks = {}
+_snapshot_locks_lock = threading.Lock()
+
+def load_latest_snapshot(file_url_root, report, report_suffix, mcc_list):
+    ''' Load the latest files of a report into the data store and publish them as a new snapshot.
+    If the files of some mccs could not be loaded at all, the previous data is published again with the new
+    failures rather than replaced by a partial or empty report.
+    '''
+    latest_files = get_latest_files_list(report_suffix, mcc_list)
+    latest_data, failures = load_data(file_url_root, report, latest_files)
+    failed_mccs = set(failure['mcc'] for failure in failures) - set(latest_data['mcc'].unique())
+    previous = _snapshots.get(report)
+    previous_handle = previous.handle if previous else find_dataset(report, 'latest')
+    if failed_mccs and previous_handle is not None:
+        print('Keeping the previous {} data, unable to load MCC {}'.format(report, ', '.join(sorted(failed_mccs))))
+        handle = previous_handle
+    else:
+        handle = save_dataset(latest_data, report, 'latest')
+    snapshot = ReportSnapshot(report, handle['key'], time.time(), handle, tuple(failures))
+    _snapshots[report] = snapshot
+    return snapshot
+
+def get_latest_snapshot(file_url_root, report, report_suffix, mcc_list, max_age):
+    ''' Return the current snapshot of a report, reloading it if it is older than max_age seconds.
+    Snapshots are replaced as a whole, never modified, so concurrent requests each see a consistent version,
+    and only one thread per process reloads a given report at a time.
+    '''
+    snapshot = _snapshots.get(report)
+    if snapshot and time.time() - snapshot.loaded < max_age:
+        return snapshot
+    with _snapshot_locks_lock:
+        lock = _snapshot_locks.setdefault(report, threading.Lock())
+    with lock:
+        snapshot = _snapshots.get(report)
+        if snapshot and time.time() - snapshot.loaded < max_age:
+            return snapshot
+        return load_latest_snapshot(file_url_root, report, report_suffix, mcc_list)
 
 
 # ----------------------------------------------------------------------------
 # Format data for Sankey
 # ----------------------------------------------------------------------------
 
+def factorize_labels(column):
+    ''' pd.factorize of a label column, with missing labels kept as one node of their own instead of code -1,
+    which would otherwise index the last label
+    '''
+    codes, uniques = pd.factorize(column)
+    uniques = np.asarray(uniques, dtype=object)
+    missing = codes == -1
+    if missing.any():
+        codes = np.where(missing, len(uniques), codes)
+        uniques = np.append(uniques, np.nan)
+    return codes, uniques
+
+def encode_sankey_links(dataframe, source_col = 'source', target_col = 'target'):
+    ''' Factorize source and target labels into shared integer node IDs.
+    Returns the node label array (sources in order of appearance, followed by targets not already seen) and
+    the integer source and target IDs for every row of the dataframe. Each column is factorized on its own,
+    which only touches the category codes for categorical columns, and the two small sets of uniques are
+    then merged into one node index.
+    '''
+    source_codes, source_uniques = factorize_labels(dataframe[source_col])
+    target_codes, target_uniques = factorize_labels(dataframe[target_col])
+    node_codes, labels = factorize_labels(np.concatenate([source_uniques, target_uniques]))
+    source_ids = node_codes[:len(source_uniques)][source_codes]
+    target_ids = node_codes[len(source_uniques):][target_codes]
+    return np.asarray(labels, dtype=object), source_ids, target_ids
+
 def get_sankey_nodes(dataframe,source_col = 'source', target_col = 'target'):
     ''' Extract node infomration from sankey dataframe in case this is not provided '''
-    nodes = pd.DataFrame(list(dataframe[source_col].unique()) + list(dataframe[target_col].unique())).drop_duplicates().reset_index(drop=True)
-    nodes.reset_index(inplace=True)
-    nodes.columns = ['NodeID','Node']
+    labels, _, _ = encode_sankey_links(dataframe, source_col, target_col)
+    nodes = pd.DataFrame({'NodeID': np.arange(len(labels)), 'Node': labels})
     return nodes
 
+def index_labels(node_index, column):
+    ''' Position of every value of column in node_index. Only the categories of a categorical column are looked up.
+    Missing values (category code -1) are looked up as NaN, the last entry of the categories.
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        categories = np.append(np.asarray(column.cat.categories, dtype=object), np.nan)
+        return node_index.get_indexer(categories)[column.cat.codes.to_numpy()]
+    return node_index.get_indexer(np.asarray(column, dtype=object))
+
+def encode_shared_sankey_links(node_labels, dataframe, source_col = 'source', target_col = 'target'):
+    ''' Encode the links of a subset of a dataset against the node index of the whole dataset.
+    Only the nodes used by the subset are kept, in the order of the shared index, so every subset draws its
+    nodes in the same relative order. Also returns the shared position of each kept node.
+    '''
+    node_index = pd.Index(node_labels)
+    shared_source = index_labels(node_index, dataframe[source_col])
+    shared_target = index_labels(node_index, dataframe[target_col])
+    used = np.unique(np.concatenate([shared_source, shared_target]))
+    labels = np.asarray(node_labels, dtype=object)[used]
+    return labels, np.searchsorted(used, shared_source), np.searchsorted(used, shared_target), used
+
 def get_sankey_dataframe (data_dataframe,
                           node_id_col = 'NodeID', node_name_col = 'Node',
-                          source_col = 'source', target_col = 'target', value_col = 'value'):
-    ''' Merge Node dataframes with data dataframe to create dataframe properly formatted for Sankey diagram.
+                          source_col = 'source', target_col = 'target', value_col = 'value',
+                          shared_nodes = None):
+    ''' Create dataframe properly formatted for Sankey diagram.
         This means each source and target gets assigned the Index value from the nodes dataframe for the diagram.
+        shared_nodes is an optional nodes dataframe of the whole dataset (see get_sankey_nodes). When it is given
+        the returned nodes also have a SharedID column with each node's position in the shared index.
     '''
-    # get nodes from data
-    nodes = get_sankey_nodes(data_dataframe)
+    with metrics.timed('sankey_encode'):
+        if shared_nodes is None:
+            labels, source_ids, target_ids = encode_sankey_links(data_dataframe, source_col, target_col)
+        else:
+            labels, source_ids, target_ids, shared_ids = encode_shared_sankey_links(
+                shared_nodes[node_name_col], data_dataframe, source_col, target_col)
+    nodes = pd.DataFrame({node_id_col: np.arange(len(labels)), node_name_col: labels})
+    if shared_nodes is not None:
+        nodes['SharedID'] = shared_ids
 
-    # Copy of Node data to merge on source
-    sources = nodes.copy()
-    sources.columns = ['sourceID','source']
+    sankey_dataframe = data_dataframe.reset_index(drop=True)
+    sankey_dataframe['sourceID'] = source_ids
+    sankey_dataframe['targetID'] = target_ids
 
-    # Copy of Node data to merge on target
-    targets = nodes.copy()
-    targets.columns = ['targetID','target']
+    return nodes, sankey_dataframe
 
-    # Merge the data dataframe with node information
-    sankey_dataframe = data_dataframe.merge(sources, on='source')
-    sankey_dataframe = sankey_dataframe.merge(targets, on='target')
 
-    return nodes, sankey_dataframe
+# ----------------------------------------------------------------------------
+# Server side table queries
+# ----------------------------------------------------------------------------
+# operators of the DataTable filter syntax, by the name used for them in filter_table
+FILTER_OPERATORS = {'ge': 'ge', '>=': 'ge', 'le': 'le', '<=': 'le', 'lt': 'lt', '<': 'lt', 'gt': 'gt', '>': 'gt',
+                    'ne': 'ne', '!=': 'ne', 'eq': 'eq', '=': 'eq', 'contains': 'contains',
+                    'datestartswith': 'datestartswith'}
+FILTER_CLAUSE = re.compile(r'^\s*\{(?P<col>[^}]+)\}\s+(?P<op>\S+)(?:\s+(?P<val>.*?))?\s*$')
+
+def split_filter_part(filter_part):
+    ''' Parse one clause of a DataTable filter_query ("{column} operator value") into (column, operator, value, text).
+    value is a float when the clause text is a number; text is the clause text as typed, without quotes.
+    Returns (None, None, None, None) for a clause that does not parse or has an unknown operator.
+    '''
+    match = FILTER_CLAUSE.match(filter_part)
+    if match is None or match.group('op') not in FILTER_OPERATORS:
+        return None, None, None, None
+    value_part = match.group('val') or ''
+    v0 = value_part[0] if value_part else ''
+    if len(value_part) > 1 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+        value = text = value_part[1: -1].replace('\\' + v0, v0)
+    else:
+        text = value_part
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+    return match.group('col'), FILTER_OPERATORS[match.group('op')], value, text
+
+def filter_table(df, filter_query):
+    ''' Apply a DataTable filter_query (clauses joined by && ) to a dataframe.
+    Clauses on unknown columns are ignored, and a comparison of a numeric column with a value that is not a number
+    matches no rows.
+    '''
+    if not filter_query:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value, filter_text = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+        column = df[col_name]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if pd.api.types.is_numeric_dtype(column):
+                try:
+                    filter_value = float(filter_text)
+                except ValueError:
+                    mask[:] = False
+                    continue
+            else:
+                # text columns are compared with the clause as typed, so "0" or "1.50" are not reformatted
+                column = column.astype(str)
+                filter_value = filter_text
+            mask &= getattr(column, operator)(filter_value).to_numpy()
+        elif operator == 'contains':
+            mask &= column.astype(str).str.contains(filter_text, regex=False).to_numpy()
+        elif operator == 'datestartswith':
+            mask &= column.astype(str).str.startswith(filter_text).to_numpy()
+    return df[mask]
+
+def query_table(df, filter_query, sort_by, page_current, page_size):
+    ''' Filter, sort and page a dataframe for a DataTable with custom paging.
+    Returns the rows of the requested page and the total number of pages.
+    '''
+    df = filter_table(df, filter_query)
+    if sort_by:
+        df = df.sort_values([col['column_id'] for col in sort_by],
+                            ascending=[col['direction'] == 'asc' for col in sort_by],
+                            inplace=False)
+    page_count = max(1, -(-len(df) // page_size))
+    start = page_current * page_size
+    return df.iloc[start:start + page_size], page_count
+
+def stream_csv(df, chunk_rows=10000):
+    ''' Generate a dataframe as csv text in chunks, so large tables are streamed rather than built in memory '''
+    yield df.iloc[:0].to_csv(index=False)
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(index=False, header=False)
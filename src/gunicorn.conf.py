@@ -0,0 +1,31 @@
+# Gunicorn settings, used by the Dockerfile and deploy/deploy.yml: gunicorn -c gunicorn.conf.py app:server
+import os
+
+# A few processes with many threads each. Request threads wait on the shared event loop of their process for
+# downloads (see http_client.py), so a thread blocked on TACC costs little and the datasets, figures and
+# connection pool of a process are shared by all of its threads.
+preload_app = True
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+bind = ':8050'
+timeout = 200
+
+def on_starting(server):
+    ''' Remove the metrics files of previous runs before any worker writes its own '''
+    import metrics
+    metrics.reset_shared_metrics()
+
+def when_ready(server):
+    ''' Load the lazily imported modules in the master before the workers are forked, so they share them.
+    Only imports: a thread started in the master would be forked with whatever locks it holds.
+    '''
+    import app
+    app.warm_imports()
+
+def post_fork(server, worker):
+    ''' Start the report refresher thread in each worker. Only the worker holding the refresher lock in
+    CACHE_PATH refreshes; the others read the files and datasets it prefetches from the shared cache directory.
+    '''
+    import app
+    app.start_background_refresh()
@@ -0,0 +1,202 @@
+# File Management
+import os # Operating system library
+import asyncio
+import atexit
+import threading
+import time
+from collections import namedtuple
+
+# import local modules
+from config_settings import (CACHE_PATH, CACHE_TTL, CACHE_MAX_BYTES,
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, HTTP_TOTAL_TIMEOUT, FETCH_WORKERS)
+from caching import DiskCache
+import metrics
+
+# ----------------------------------------------------------------------------
+# ASYNC HTTP CLIENT
+# ----------------------------------------------------------------------------
+# Each process runs one asyncio event loop in a background thread, with a single aiohttp session on it.
+# Request threads hand their downloads to the loop and wait for the result, so all threads of a worker share
+# one connection pool, and identical requests in flight at the same time share a single download.
+# aiohttp is imported by the coroutines that use it, so importing this module does not load it.
+RETRY_STATUSES = (502, 503, 504)
+
+HttpResponse = namedtuple('HttpResponse', ['status_code', 'headers', 'content'])
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_client = None
+_inflight = {}
+
+def get_loop():
+    ''' Return the event loop of this process, starting it on first use.
+    Threads do not survive a fork, so each gunicorn worker starts its own loop.
+    '''
+    global _loop, _loop_pid, _client, _inflight
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='http-client', daemon=True).start()
+            _loop = loop
+            _loop_pid = os.getpid()
+            _client = None
+            _inflight = {}
+            atexit.register(close)
+    return _loop
+
+def close():
+    ''' Close the aiohttp session and stop the event loop of this process '''
+    global _loop
+    with _loop_lock:
+        loop, _loop = _loop, None
+    if loop is None or _loop_pid != os.getpid():
+        return
+    if _client is not None:
+        asyncio.run_coroutine_threadsafe(_client.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+def run(coro):
+    ''' Run a coroutine on the event loop of this process and wait for its result '''
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+def _get_client():
+    ''' aiohttp session of this process. Only called on the event loop '''
+    global _client
+    import aiohttp
+    if _client is None or _client.closed:
+        _client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=FETCH_WORKERS),
+            timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+        )
+    return _client
+
+async def _get(url, headers=None):
+    ''' GET url, retrying connection errors and 502/503/504 with exponential backoff.
+    The request and its retries must finish within HTTP_TOTAL_TIMEOUT seconds: the socket timeouts only bound
+    each connect and read, so a server sending a few bytes at a time could otherwise hold the request forever.
+    Raises aiohttp.ClientError or asyncio.TimeoutError if the server cannot be reached.
+    '''
+    return await asyncio.wait_for(_get_with_retries(url, headers), HTTP_TOTAL_TIMEOUT)
+
+async def _get_with_retries(url, headers):
+    import aiohttp
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            async with _get_client().get(url, headers=headers) as response:
+                if response.status not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                    return HttpResponse(response.status, response.headers.copy(), await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == HTTP_RETRIES:
+                raise
+        await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+
+async def _single_flight(key, make_coro):
+    ''' Await make_coro(), sharing its result with concurrent callers that use the same key '''
+    task = _inflight.get(key)
+    if task is not None:
+        metrics.increment('a2cps_fetch_coalesced_total')
+    else:
+        task = asyncio.ensure_future(make_coro())
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _inflight.pop(key, None))
+    # shielded so that a cancelled caller does not cancel the download for the others
+    return await asyncio.shield(task)
+
+def http_get(url, headers=None):
+    ''' Uncached GET of url. Concurrent requests with the same url and headers share one response.
+    Returns an HttpResponse. Raises aiohttp.ClientError or asyncio.TimeoutError if the server cannot be reached.
+    '''
+    key = ('get', url, tuple(sorted((headers or {}).items())))
+    return run(_single_flight(key, lambda: _get(url, headers)))
+
+# ----------------------------------------------------------------------------
+# CACHED DOWNLOADS FROM TACC
+# ----------------------------------------------------------------------------
+_file_cache = None
+
+def get_file_cache():
+    ''' Return the shared on-disk cache for downloaded files, creating the directory on first use '''
+    global _file_cache
+    if _file_cache is None:
+        _file_cache = DiskCache(CACHE_PATH.joinpath('files'), CACHE_MAX_BYTES)
+    return _file_cache
+
+def fetch_url(url, ttl=None, stage='fetch', labels=None):
+    ''' Return the content of url as bytes, served from the shared file cache when possible.
+    Entries younger than ttl seconds are returned without contacting the server.  Older entries are
+    revalidated with ETag / Last-Modified headers, and are returned stale if the server errors (5xx)
+    or cannot be reached.  Returns None if the file is unavailable and nothing is cached.
+    The call is timed as stage (with labels) in the metrics.
+    '''
+    return run(fetch_url_async(url, ttl, stage, labels))
+
+async def fetch_url_async(url, ttl=None, stage='fetch', labels=None):
+    ''' Coroutine version of fetch_url, to be awaited on the event loop returned by get_loop() '''
+    with metrics.timed(stage, **(labels or {})):
+        if ttl is None:
+            ttl = CACHE_TTL
+        # the cache is on local disk: read it off the loop so other downloads keep going
+        entry = await asyncio.get_event_loop().run_in_executor(None, get_file_cache().get, url)
+        if entry and time.time() - entry['fetched'] < ttl:
+            metrics.cache_hit('files')
+            return entry['content']
+        return await _single_flight(('file', url), lambda: _download(url, entry))
+
+async def _download(url, entry):
+    ''' Download url, revalidating the cached entry if there is one, and update the file cache '''
+    import aiohttp
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    try:
+        response = await _get(url, headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print('Unable to fetch {}: {!r}'.format(url, e))
+        return _stale(entry)
+
+    loop = asyncio.get_event_loop()
+    if response.status_code == 304 and entry:
+        metrics.increment('a2cps_cache_requests_total', cache='files', result='revalidated')
+        entry['fetched'] = time.time()
+        await loop.run_in_executor(None, get_file_cache().set, url, entry)
+        return entry['content']
+    if response.status_code == 200:
+        metrics.cache_miss('files')
+        metrics.increment('a2cps_fetch_bytes_total', len(response.content))
+        entry = {
+            'content': response.content,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time(),
+        }
+        await loop.run_in_executor(None, get_file_cache().set, url, entry)
+        return entry['content']
+    if response.status_code >= 500:
+        return _stale(entry)
+    metrics.increment('a2cps_fetch_errors_total', status=response.status_code)
+    return None
+
+def _stale(entry):
+    ''' Content of a cached entry to use when the server cannot be reached, or None '''
+    if entry:
+        metrics.increment('a2cps_cache_requests_total', cache='files', result='stale')
+        return entry['content']
+    metrics.increment('a2cps_fetch_errors_total', status='unavailable')
+    return None
+
+def fetch_many(urls, ttl=None, stage='fetch', labels=None):
+    ''' Fetch several urls concurrently on the event loop.
+    labels is an optional list with the metrics labels of each url.
+    Returns the contents (bytes or None) in the same order as urls.
+    '''
+    urls = list(urls)
+    labels = labels or [None] * len(urls)
+    return run(_fetch_all(urls, ttl, stage, labels))
+
+async def _fetch_all(urls, ttl, stage, labels):
+    return await asyncio.gather(*[fetch_url_async(url, ttl, stage, url_labels) for url, url_labels in zip(urls, labels)])
@@ -0,0 +1,113 @@
+# File Management
+import os # Operating system library
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+# import local modules
+from config_settings import CACHE_PATH
+import metrics
+
+# ----------------------------------------------------------------------------
+# LOCAL REPORT FILES
+# ----------------------------------------------------------------------------
+# Same interface as http_client for reports mirrored on local disk. The root is a directory laid out like the
+# TACC reports folder (<report>/index.json and the csv files it lists), or a .zip / .tar / .tar.gz / .tgz archive
+# of one. Archives are unpacked once into CACHE_PATH/archives and then read like a directory.
+# Parsed datasets go through the same memory-mapped Arrow dataset store as downloaded ones.
+ARCHIVES_PATH = CACHE_PATH.joinpath('archives')
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+_archive_roots = {}
+_archive_lock = threading.Lock()
+
+def is_local(url):
+    ''' True if url is a local path or file:// url rather than an http(s) url '''
+    return not url.startswith(('http://', 'https://'))
+
+def local_path(url):
+    return url[len('file://'):] if url.startswith('file://') else url
+
+def split_archive(path):
+    ''' Split a path into (archive path, path inside the archive), or (None, path) if no part is an archive '''
+    parts = path.split('/')
+    for i in range(1, len(parts) + 1):
+        candidate = '/'.join(parts[:i])
+        if candidate.endswith(ARCHIVE_SUFFIXES) and os.path.isfile(candidate):
+            return candidate, '/'.join(parts[i:])
+    return None, path
+
+def safe_members(names):
+    ''' Archive member names that stay inside the extraction directory '''
+    return [name for name in names
+            if not os.path.isabs(name) and '..' not in name.replace('\\', '/').split('/')]
+
+def unpack_archive(archive):
+    ''' Directory holding the unpacked archive, unpacking it on first use.
+    The directory is named after the archive path, size and mtime, so a replaced archive is unpacked again.
+    '''
+    stat = os.stat(archive)
+    key = hashlib.sha1('{}:{}:{}'.format(os.path.abspath(archive), stat.st_size, stat.st_mtime).encode('utf-8')).hexdigest()
+    with _archive_lock:
+        root = _archive_roots.get(key)
+        if root is None:
+            target = str(ARCHIVES_PATH.joinpath(key))
+            if not os.path.isdir(target):
+                os.makedirs(str(ARCHIVES_PATH), exist_ok=True)
+                tmp_dir = tempfile.mkdtemp(dir=str(ARCHIVES_PATH), suffix='.tmp')
+                try:
+                    if archive.endswith('.zip'):
+                        with zipfile.ZipFile(archive) as zf:
+                            zf.extractall(tmp_dir, members=safe_members(zf.namelist()))
+                    else:
+                        with tarfile.open(archive) as tf:
+                            names = set(safe_members(tf.getnames()))
+                            tf.extractall(tmp_dir, members=[m for m in tf.getmembers()
+                                                            if m.name in names and (m.isfile() or m.isdir())])
+                    os.rename(tmp_dir, target)
+                except OSError:
+                    # another worker finished unpacking the same archive first
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    if not os.path.isdir(target):
+                        raise
+            root = target
+            _archive_roots[key] = root
+    return root
+
+def resolve(url):
+    ''' Local file path for a url under a directory or archive root.
+    Archives made from a reports folder (reports/<report>/...) are read as if the folder were their root.
+    '''
+    archive, inner_path = split_archive(local_path(url))
+    if archive is None:
+        return inner_path
+    root = unpack_archive(archive)
+    path = os.path.join(root, inner_path)
+    if not os.path.exists(path):
+        entries = os.listdir(root)
+        if len(entries) == 1:
+            path = os.path.join(root, entries[0], inner_path)
+    return path
+
+def fetch_url(url, ttl=None, stage='fetch', labels=None):
+    ''' Return the content of a local report file as bytes, or None if it is missing or unreadable.
+    ttl is accepted for compatibility with http_client.fetch_url: local files are always read as they are now.
+    The call is timed as stage (with labels) in the metrics.
+    '''
+    with metrics.timed(stage, **(labels or {})):
+        try:
+            with open(resolve(url), 'rb') as f:
+                return f.read()
+        except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+            print('Unable to read {}: {}'.format(url, e))
+            metrics.increment('a2cps_fetch_errors_total', status='unavailable')
+            return None
+
+def fetch_many(urls, ttl=None, stage='fetch', labels=None):
+    ''' Read several local report files. Returns the contents (bytes or None) in the same order as urls '''
+    urls = list(urls)
+    labels = labels or [None] * len(urls)
+    return [fetch_url(url, ttl, stage, url_labels) for url, url_labels in zip(urls, labels)]
@@ -0,0 +1,118 @@
+# File Management
+import os # Operating system library
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# import local modules
+from config_settings import CACHE_PATH
+
+# ----------------------------------------------------------------------------
+# METRICS COLLECTION
+# ----------------------------------------------------------------------------
+# Each worker process keeps its own counters and periodically writes them to CACHE_PATH/metrics/<pid>.json.
+# The /metrics route sums the files of all workers, so whichever worker serves a scrape reports the totals.
+METRICS_PATH = CACHE_PATH.joinpath('metrics')
+FLUSH_INTERVAL = 1.0 # seconds between writes of this process's metrics file
+
+_counters = {} # (name, labels) -> value
+_lock = threading.Lock()
+_last_flush = 0.0
+
+def _reset_after_fork():
+    ''' Start a forked child with empty counters. It would otherwise write the parent's counts to its own file,
+    and collect() would add them once per worker.
+    '''
+    global _counters, _lock, _last_flush
+    _counters = {}
+    _lock = threading.Lock()
+    _last_flush = 0.0
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def increment(name, value=1, **labels):
+    ''' Add value to the counter name{labels} '''
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        flush_due = time.time() - _last_flush > FLUSH_INTERVAL
+    if flush_due:
+        flush()
+
+def observe(name, seconds, **labels):
+    ''' Record one timing of name{labels} as a Prometheus summary (_sum and _count) '''
+    increment(name + '_sum', seconds, **labels)
+    increment(name + '_count', 1, **labels)
+
+def cache_hit(cache):
+    increment('a2cps_cache_requests_total', cache=cache, result='hit')
+
+def cache_miss(cache):
+    increment('a2cps_cache_requests_total', cache=cache, result='miss')
+
+@contextmanager
+def timed(stage, **labels):
+    ''' Time the enclosed block as a stage of the request pipeline '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('a2cps_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+def flush():
+    ''' Write this process's counters to its metrics file '''
+    global _last_flush
+    with _lock:
+        _last_flush = time.time()
+        snapshot = [[name, list(labels), value] for (name, labels), value in _counters.items()]
+    try:
+        os.makedirs(str(METRICS_PATH), exist_ok=True)
+        path = METRICS_PATH.joinpath('{}.json'.format(os.getpid()))
+        tmp_path = str(path) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, str(path))
+    except OSError as e:
+        print('Unable to write metrics: {}'.format(e))
+
+def reset_shared_metrics():
+    ''' Remove the metrics files left by previous runs. Called once by the gunicorn master at startup '''
+    if not METRICS_PATH.exists():
+        return
+    for path in METRICS_PATH.glob('*.json'):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+def collect():
+    ''' Sum the counters of every process that has written a metrics file '''
+    flush()
+    totals = {}
+    for path in METRICS_PATH.glob('*.json'):
+        try:
+            with open(str(path)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in snapshot:
+            key = (name, tuple(tuple(label) for label in labels))
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+def render_prometheus():
+    ''' Metrics of all workers in the Prometheus text exposition format '''
+    lines = []
+    types_written = set()
+    for (name, labels), value in sorted(collect().items()):
+        family = name[:-len('_sum')] if name.endswith('_sum') else name[:-len('_count')] if name.endswith('_count') else name
+        if family not in types_written:
+            types_written.add(family)
+            lines.append('# TYPE {} {}'.format(family, 'counter' if family == name else 'summary'))
+        label_text = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+        lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', repr(float(value))))
+    return '\n'.join(lines) + '\n'
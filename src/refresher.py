@@ -0,0 +1,92 @@
+# File Management
+import os # Operating system library
+import fcntl
+import threading
+import time
+
+# import local modules
+from config_settings import CACHE_PATH
+from data_processing import get_history_index, load_latest_snapshot, find_dataset, load_data, save_dataset
+from trends import update_trend_cube
+
+# ----------------------------------------------------------------------------
+# BACKGROUND REFRESH OF REPORT DATA
+# ----------------------------------------------------------------------------
+
+def refresh_report(file_url_root, report, report_suffix, mcc_list, prefetch_dates, build_trends=True):
+    ''' Poll index.json and the latest files of a report, then prefetch any of the most recent
+    prefetch_dates historical dates that are not yet in the columnar dataset store.
+    If build_trends is set, up to prefetch_dates dates missing from the saved trend cube are added to it.
+    Returns the list of dates that were newly loaded.
+    '''
+    history_index = get_history_index(file_url_root, report, ttl=0)
+    load_latest_snapshot(file_url_root, report, report_suffix, mcc_list)
+    new_dates = []
+    for selected_date in history_index.dates()[:prefetch_dates]:
+        if find_dataset(report, selected_date) is not None:
+            continue
+        selected_date_data, failures = load_data(file_url_root, report, history_index.files_for_date(selected_date))
+        if len(selected_date_data) > 0:
+            save_dataset(selected_date_data, report, selected_date)
+            new_dates.append(selected_date)
+    if build_trends:
+        update_trend_cube(file_url_root, report, history_index, prefetch_dates)
+    return new_dates
+
+REFRESH_LOCK_PATH = CACHE_PATH.joinpath('refresher.lock')
+
+def try_refresh_lock():
+    ''' Try to take the host-wide refresher lock without blocking. Returns the open lock file, or None if another
+    process holds it. The lock is released by the operating system when the holding process exits.
+    '''
+    os.makedirs(str(CACHE_PATH), exist_ok=True)
+    lock_file = open(str(REFRESH_LOCK_PATH), 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+class Refresher(threading.Thread):
+    ''' Daemon thread that calls refresh_report every interval seconds.
+    Under gunicorn every worker starts one after it is forked (see gunicorn.conf.py), but only the worker holding
+    the refresher file lock in CACHE_PATH refreshes; the others retry the lock each interval, so another worker
+    takes over if the holder dies. All workers pick up the results from the shared cache directory.
+    '''
+    def __init__(self, interval, file_url_root, report, report_suffix, mcc_list, prefetch_dates):
+        super().__init__(name='report-refresher', daemon=True)
+        self.interval = interval
+        self.args = (file_url_root, report, report_suffix, mcc_list, prefetch_dates)
+        self.stopped = threading.Event()
+        self.lock_file = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.time()
+            if self.lock_file is None:
+                self.lock_file = try_refresh_lock()
+            if self.lock_file is not None:
+                try:
+                    new_dates = refresh_report(*self.args)
+                    if new_dates:
+                        print('Prefetched {report} data for {dates}'.format(report=self.args[1], dates=', '.join(new_dates)))
+                except Exception as e:
+                    print('Report refresh failed: {}'.format(e))
+            self.stopped.wait(max(0, self.interval - (time.time() - start)))
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+    def stop(self):
+        self.stopped.set()
+
+_refresher = None
+
+def start_refresher(interval, file_url_root, report, report_suffix, mcc_list, prefetch_dates):
+    ''' Start the background refresher once per process. Does nothing if interval is 0 '''
+    global _refresher
+    if interval <= 0 or (_refresher is not None and _refresher.is_alive()):
+        return _refresher
+    _refresher = Refresher(interval, file_url_root, report, report_suffix, mcc_list, prefetch_dates)
+    _refresher.start()
+    return _refresher
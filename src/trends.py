@@ -0,0 +1,210 @@
+# Data Loading
+import os # Operating system library
+import hashlib
+import numpy as np
+import pandas as pd
+
+# import local modules
+from config_settings import CACHE_PATH, CACHE_MAX_BYTES
+from caching import DiskCache
+from data_processing import find_dataset, read_dataset, load_data, validate_flows, ALL_MCCS
+import metrics
+
+# ----------------------------------------------------------------------------
+# TREND CUBE
+# ----------------------------------------------------------------------------
+
+class TrendCube:
+    ''' Link values of a report across its historical dates, as a (date x mcc x link) array.
+    dates are in ascending order, mccs are strings and links is a dataframe with the source and target of each
+    link index. Missing links are 0. All queries slice the array instead of rebuilding per-date dataframes.
+    '''
+    def __init__(self, dates, mccs, links, values, version=None):
+        self.version = version
+        self.dates = list(dates)
+        self.mccs = list(mccs)
+        self.links = links
+        self.values = values
+        self._mcc_index = {mcc: i for i, mcc in enumerate(self.mccs)}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def mcc_values(self, mcc):
+        ''' (date x link) values of one mcc, or None if the mcc is not in the cube. ALL_MCCS sums every mcc '''
+        if str(mcc) == ALL_MCCS:
+            return self.values.sum(axis=1) if self.mccs else None
+        m = self._mcc_index.get(str(mcc))
+        if m is None:
+            return None
+        return self.values[:, m, :]
+
+    def link_labels(self):
+        return (self.links['source'] + ' -> ' + self.links['target']).to_numpy()
+
+    def deltas(self, mcc, periods=1):
+        ''' Change of every link between the last date and the date periods before it, as a dataframe '''
+        values = self.mcc_values(mcc)
+        if values is None or len(self.dates) <= periods:
+            return None
+        latest = values[-1]
+        previous = values[-1 - periods]
+        deltas = self.links.copy()
+        deltas['previous'] = previous
+        deltas['latest'] = latest
+        deltas['change'] = latest.astype(np.int64) - previous.astype(np.int64)
+        used = (latest != 0) | (previous != 0)
+        return deltas[used].reset_index(drop=True)
+
+def build_trend_cube(dated_frames, version=None):
+    ''' Build a TrendCube from a list of (date, consort dataframe) pairs.
+    All frames are stacked once, the dates, mccs and (source, target) links are factorized and the values are
+    scattered into the cube in a single vectorized assignment.
+    '''
+    dated_frames = sorted(dated_frames, key=lambda pair: pair[0])
+    if not dated_frames:
+        return TrendCube([], [], pd.DataFrame(columns=['source', 'target']), np.zeros((0, 0, 0), dtype=np.int32), version)
+    dates = [selected_date for selected_date, df in dated_frames]
+    lengths = np.array([len(df) for selected_date, df in dated_frames])
+    stacked = pd.concat([df[['source', 'target', 'value', 'mcc']].astype({'source': object, 'target': object, 'mcc': object})
+                         for selected_date, df in dated_frames], ignore_index=True)
+    date_codes = np.repeat(np.arange(len(dates)), lengths)
+    mcc_codes, mccs = pd.factorize(stacked['mcc'].astype(str), sort=True)
+    link_codes, links = pd.factorize(pd.MultiIndex.from_arrays([stacked['source'], stacked['target']]))
+    links_df = pd.DataFrame({'source': links.get_level_values(0).astype(str), 'target': links.get_level_values(1).astype(str)})
+    values = np.zeros((len(dates), len(mccs), len(links_df)), dtype=np.int32)
+    np.add.at(values, (date_codes, mcc_codes, link_codes), stacked['value'].to_numpy(dtype=np.int32))
+    return TrendCube(dates, [str(mcc) for mcc in mccs], links_df, values, version)
+
+def merge_trend_cubes(cube, added, version=None):
+    ''' TrendCube with the dates of added inserted into cube. The two must not share dates.
+    mccs and links missing from either cube are 0 there, so only the old values are copied, never restacked.
+    '''
+    dates = cube.dates + added.dates
+    mccs = sorted(set(cube.mccs) | set(added.mccs))
+    links = pd.MultiIndex.from_frame(cube.links[['source', 'target']])
+    added_links = pd.MultiIndex.from_frame(added.links[['source', 'target']])
+    links = links.append(added_links[~added_links.isin(links)])
+    order = np.argsort(dates, kind='stable')
+    date_pos = np.empty(len(dates), dtype=np.intp)
+    date_pos[order] = np.arange(len(dates))
+    mcc_index = pd.Index(mccs)
+    values = np.zeros((len(dates), len(mccs), len(links)), dtype=np.int32)
+    for part, date_slice in [(cube, date_pos[:len(cube.dates)]), (added, date_pos[len(cube.dates):])]:
+        if len(part.dates) and len(part.mccs) and len(part.links):
+            values[np.ix_(date_slice, mcc_index.get_indexer(part.mccs),
+                          links.get_indexer(pd.MultiIndex.from_frame(part.links[['source', 'target']])))] = part.values
+    links_df = pd.DataFrame({'source': links.get_level_values(0).astype(str), 'target': links.get_level_values(1).astype(str)})
+    return TrendCube([dates[i] for i in order], mccs, links_df, values, version)
+
+# ----------------------------------------------------------------------------
+# CACHED TREND CUBES
+# ----------------------------------------------------------------------------
+# Cubes are only built by the background refresher (see refresher.py). Each refresh adds the dates the saved cube
+# is missing, at most PREFETCH_DATES of them, to the previous cube. Requests only load the last saved cube.
+TRENDS_PATH = CACHE_PATH.joinpath('trends')
+_trend_meta = None
+_trend_cubes = {}
+
+def get_trend_meta():
+    ''' Return the on-disk store of trend cube metadata (version, dates, mccs, links, date signatures) '''
+    global _trend_meta
+    if _trend_meta is None:
+        _trend_meta = DiskCache(TRENDS_PATH, CACHE_MAX_BYTES)
+    return _trend_meta
+
+def date_signatures(history_index):
+    ''' Hash of the (mcc, file) rows of each date of a history index, to tell when a date's files change '''
+    return {selected_date: hashlib.sha1(repr(sorted(
+                (mcc, file) for f in history_index.files_for_date(selected_date) for mcc, file in f.items()
+            )).encode('utf-8')).hexdigest()
+            for selected_date in history_index.dates()}
+
+def trend_version(signatures):
+    ''' Version of a cube: a hash of the dates it holds and their signatures '''
+    return hashlib.sha1(repr(sorted(signatures.items())).encode('utf-8')).hexdigest()
+
+def load_trend_frames(file_url_root, report, history_index, dates):
+    ''' Datasets of some dates of the history index. Dates already in the dataset store are read from it; the
+    others are downloaded and repaired but not stored, so the store keeps only the PREFETCH_DATES most recent dates.
+    '''
+    dated_frames = []
+    for selected_date in dates:
+        handle = find_dataset(report, selected_date)
+        df = read_dataset(handle) if handle else None
+        if df is None:
+            df, failures = load_data(file_url_root, report, history_index.files_for_date(selected_date))
+            if len(df) == 0:
+                continue
+            df, issues = validate_flows(df)
+        dated_frames.append((selected_date, df))
+    return dated_frames
+
+def save_trend_cube(report, cube, signatures):
+    ''' Save the cube values as .npy and its labels in the metadata store, replacing older versions '''
+    meta = get_trend_meta() # also creates TRENDS_PATH
+    values_path = TRENDS_PATH.joinpath('{}-{}.npy'.format(report, cube.version))
+    tmp_path = str(values_path) + '.tmp.npy'
+    np.save(tmp_path, cube.values)
+    os.replace(tmp_path, str(values_path))
+    meta.set(report, {'version': cube.version, 'dates': cube.dates, 'mccs': cube.mccs, 'links': cube.links,
+                      'signatures': signatures})
+    for old_path in TRENDS_PATH.glob('{}-*.npy'.format(report)):
+        if old_path != values_path:
+            try:
+                old_path.unlink()
+            except OSError:
+                pass
+
+def load_saved_cube(report):
+    ''' Return the last saved TrendCube of a report and the signatures of its dates, or (None, {}) '''
+    meta = get_trend_meta().get(report)
+    if meta is None:
+        return None, {}
+    cube = _trend_cubes.get(report)
+    if cube is None or cube.version != meta['version']:
+        values_path = TRENDS_PATH.joinpath('{}-{}.npy'.format(report, meta['version']))
+        try:
+            values = np.load(str(values_path), mmap_mode='r')
+        except (OSError, ValueError):
+            # replaced by a newer version since the metadata was read
+            return _trend_cubes.get(report), {}
+        cube = TrendCube(meta['dates'], meta['mccs'], meta['links'], values, meta['version'])
+        _trend_cubes[report] = cube
+    return cube, meta['signatures']
+
+def get_trend_cube(report):
+    ''' Return the last TrendCube saved by the refresher, or None if it has not built one yet. Never builds one:
+    the values are memory mapped from the .npy file under CACHE_PATH.
+    '''
+    cube, signatures = load_saved_cube(report)
+    if cube is None:
+        metrics.cache_miss('trends')
+    else:
+        metrics.cache_hit('trends')
+    return cube
+
+def update_trend_cube(file_url_root, report, history_index, max_new_dates):
+    ''' Bring the saved cube of a report up to date with its history index, and return it.
+    Dates no longer listed are dropped, dates whose files changed are reloaded, and at most max_new_dates of the
+    missing dates, most recent first, are loaded and added to the previous cube. Called by the refresher only.
+    '''
+    signatures = date_signatures(history_index)
+    cube, saved_signatures = load_saved_cube(report)
+    if cube is None:
+        cube = build_trend_cube([])
+    kept = [d for d in cube.dates if d in signatures and saved_signatures.get(d) == signatures[d]]
+    kept_set = set(kept)
+    missing = [d for d in history_index.dates() if d not in kept_set][:max_new_dates]
+    if not missing and len(kept) == len(cube.dates):
+        return cube
+    with metrics.timed('trend_build'):
+        if len(kept) < len(cube.dates):
+            kept_pos = [i for i, d in enumerate(cube.dates) if d in kept_set]
+            cube = TrendCube(kept, cube.mccs, cube.links, np.asarray(cube.values[kept_pos]))
+        added = build_trend_cube(load_trend_frames(file_url_root, report, history_index, missing))
+        kept_signatures = {d: signatures[d] for d in kept + added.dates}
+        cube = merge_trend_cubes(cube, added, trend_version(kept_signatures))
+    save_trend_cube(report, cube, kept_signatures)
+    _trend_cubes[report] = cube
+    return cube
@@ -0,0 +1,8 @@
+''' The tests import the modules in src/ directly, like the benchmarks. '''
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('CACHE_PATH', tempfile.mkdtemp(prefix='a2cps_tests_'))
+os.environ.setdefault('REFRESH_INTERVAL', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
@@ -0,0 +1,80 @@
+''' Server side filtering, sorting and paging of the data table (split_filter_part, filter_table, query_table) '''
+import pandas as pd
+import pytest
+
+from data_processing import split_filter_part, filter_table, query_table
+
+LOST = 'Early Terminations - Subject is lost to follow-up, unable to locate'
+
+
+@pytest.fixture
+def links():
+    return pd.DataFrame({
+        'source': ['Screened Patients', 'Screened Patients', 'Patients With Surgery', 'Patients With Surgery',
+                   'Reaching Month 3', '0'],
+        'target': ['Declined - Time related', 'Consented Patients', LOST, 'Patients Reaching Week 6', LOST, '1.50'],
+        'value': [762, 476, 2, 377, 3, 0],
+        'mcc': ['1', '1', '1', '2', '2', '2'],
+    }).astype({'source': 'category', 'target': 'category'})
+
+
+@pytest.mark.parametrize('clause, expected', [
+    ('{value} >= 3', ('value', 'ge', 3.0, '3')),
+    ('{value} ge 3', ('value', 'ge', 3.0, '3')),
+    ('{value} < 10', ('value', 'lt', 10.0, '10')),
+    ('{mcc} = 1', ('mcc', 'eq', 1.0, '1')),
+    ('{mcc} != "2"', ('mcc', 'ne', '2', '2')),
+    ('{target} contains "unable to locate"', ('target', 'contains', 'unable to locate', 'unable to locate')),
+    ('{target} = "' + LOST + '"', ('target', 'eq', LOST, LOST)),
+    ('{target} contains \'it\\\'s\'', ('target', 'contains', "it's", "it's")),
+    ('{source} contains Month', ('source', 'contains', 'Month', 'Month')),
+    ('{source} datestartswith 2021-04', ('source', 'datestartswith', '2021-04', '2021-04')),
+])
+def test_split_filter_part(clause, expected):
+    assert split_filter_part(clause) == expected
+
+
+@pytest.mark.parametrize('clause', ['value >= 3', '{value} between 1', '{value}', 'le to locate'])
+def test_split_filter_part_rejects_malformed_clauses(clause):
+    assert split_filter_part(clause) == (None, None, None, None)
+
+
+@pytest.mark.parametrize('filter_query, rows', [
+    ('{target} contains "unable to locate"', [2, 4]),
+    ('{target} = "' + LOST + '"', [2, 4]),
+    ('{target} ne "' + LOST + '"', [0, 1, 3, 5]),
+    ('{value} > 100', [0, 1, 3]),
+    ('{value} <= 3', [2, 4, 5]),
+    ('{value} = "3"', [4]),
+    ('{mcc} = 2 && {value} > 2', [3, 4]),
+    ('{source} = 0', [5]),
+    ('{target} = 1.50', [5]),
+    ('{source} contains Patients', [0, 1, 2, 3]),
+    ('{missing} = 1', [0, 1, 2, 3, 4, 5]),
+    ('', [0, 1, 2, 3, 4, 5]),
+])
+def test_filter_table(links, filter_query, rows):
+    assert filter_table(links, filter_query).index.tolist() == rows
+
+
+@pytest.mark.parametrize('filter_query', ['{value} > abc', '{value} = "two"', '{value} = '])
+def test_filter_table_non_numeric_value_on_numeric_column_matches_nothing(links, filter_query):
+    assert len(filter_table(links, filter_query)) == 0
+
+
+def test_query_table_pages_filtered_and_sorted_rows(links):
+    page, page_count = query_table(links, '{value} > 1', [{'column_id': 'value', 'direction': 'desc'}], 1, 2)
+    assert page_count == 3
+    assert page['value'].tolist() == [377, 3]
+
+
+def test_query_table_past_the_last_page_is_empty(links):
+    page, page_count = query_table(links, '{mcc} = 1', [], 5, 2)
+    assert page_count == 2
+    assert len(page) == 0
+
+
+def test_query_table_without_rows_has_one_page(links):
+    page, page_count = query_table(links, '{value} > abc', [], 0, 10)
+    assert page_count == 1
+    assert len(page) == 0